@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+# compares the CPU time spent decoding request bodies of bulk task submissions with chardet and with decode_data
+# usage: python3 benchmarks/decode_request_data.py [NUM_TASKS] [REPETITIONS]
+
+import os
+import sys
+import json
+import chardet
+from time import process_time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from cc_server.commons.helper import decode_data
+
+
+def _task(i):
+    return {
+        'tags': ['benchmark', 'tâche {}'.format(i)],
+        'application_container_description': {
+            'image': 'docker.io/curiouscontainers/cc-sample-app',
+            'container_ram': 1024,
+            'parameters': ['--alpha', str(i / 1000), '--name', 'übung-{}'.format(i)]
+        },
+        'input_files': [{
+            'connector_type': 'http',
+            'connector_access': {
+                'url': 'https://my-domain.tld/input_files/{}/some_data.csv'.format(i)
+            }
+        }],
+        'result_files': [{
+            'local_result_file': 'file_a',
+            'connector_type': 'http',
+            'connector_access': {
+                'url': 'https://my-domain.tld/result_files/{}/'.format(i),
+                'method': 'POST'
+            }
+        }]
+    }
+
+
+def _chardet(data, charset=None):
+    enc = chardet.detect(data)
+    return data.decode(enc['encoding'])
+
+
+def _measure(decode, data, charset, repetitions):
+    start = process_time()
+    for _ in range(repetitions):
+        decode(data, charset)
+    return (process_time() - start) / repetitions
+
+
+def main():
+    num_tasks = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    repetitions = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+
+    body = json.dumps({'tasks': [_task(i) for i in range(num_tasks)]}, ensure_ascii=False)
+    data = body.encode('utf-8')
+    print('{} tasks, {:.1f} MB request body, {} repetitions'.format(num_tasks, len(data) / 1024 ** 2, repetitions))
+
+    assert decode_data(data) == body
+
+    cases = [
+        ('chardet.detect', _chardet, None),
+        ('decode_data without charset', decode_data, None),
+        ('decode_data with charset=utf-8', decode_data, 'utf-8')
+    ]
+    baseline = None
+    for name, decode, charset in cases:
+        seconds = _measure(decode, data, charset, repetitions)
+        if baseline is None:
+            baseline = seconds
+        print('{:<32} {:10.4f} s CPU per request {:8.1f}x'.format(name, seconds, baseline / max(seconds, 1e-9)))
+
+
+if __name__ == '__main__':
+    main()
@@ -41,6 +41,8 @@ class Config:
         self.server_files = config.get('server_files')
         self.mongo = config['mongo']
         self.docker = config['docker']
+        self.fake_cluster = config.get('fake_cluster')
+        self.local_cluster = config.get('local_cluster')
         self.defaults = config['defaults']
 
         if args.mongo_host:
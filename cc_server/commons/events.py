@@ -0,0 +1,145 @@
+from datetime import datetime, timedelta
+from bson.objectid import ObjectId
+from pymongo import ASCENDING
+from pymongo.errors import CollectionInvalid
+
+from cc_server.commons.helper import remove_secrets
+
+EVENTS_COLLECTION = 'events'
+
+# every write of events is registered here while it is in progress, see feed
+EVENT_WRITES_COLLECTION = 'event_writes'
+
+# events may be written up to this long after their date, resuming the feed looks back accordingly. Writes registered
+# longer ago are considered failed and do not hold back the feed anymore
+FEED_LOOKBACK_SECONDS = 60
+
+
+def _event(collection, _id, event_type, data, username=None):
+    event = remove_secrets(data)
+    event['meta'] = {
+        'collection': collection,
+        'document_id': _id,
+        'event_type': event_type,
+        'username': username
+    }
+    event['date'] = datetime.utcfromtimestamp(data['timestamp'])
+    return event
+
+
+# append-only history of transitions and callbacks, used instead of the transitions and callbacks arrays of the
+# documents if mongo.events.enabled is set
+class Events:
+    def __init__(self, config, mongo):
+        self._mongo = mongo
+
+        events = config.mongo.get('events', {})
+        self.enabled = events.get('enabled', False)
+        self._time_series = events.get('time_series', False)
+
+    def create_collection(self):
+        if not self.enabled:
+            return
+
+        if self._time_series:
+            try:
+                self._mongo.db.create_collection(
+                    EVENTS_COLLECTION,
+                    timeseries={'timeField': 'date', 'metaField': 'meta'}
+                )
+            except CollectionInvalid:
+                pass
+
+        self._mongo.db[EVENTS_COLLECTION].create_index([
+            ('meta.document_id', ASCENDING),
+            ('date', ASCENDING)
+        ])
+        self._mongo.db[EVENTS_COLLECTION].create_index([
+            ('meta.username', ASCENDING),
+            ('date', ASCENDING)
+        ])
+        # registrations of writes interrupted by a crash expire
+        self._mongo.db[EVENT_WRITES_COLLECTION].create_index('started_at', expireAfterSeconds=FEED_LOOKBACK_SECONDS)
+
+    def append(self, collection, _id, event_type, data, username=None):
+        self._write([(collection, _id, event_type, data, username)])
+
+    def append_many(self, events):
+        # events are tuples of (collection, _id, event_type, data, username)
+        self._write(events)
+
+    def _write(self, events):
+        # the write is registered before the ObjectIds of the events are generated by pymongo, such that the feed can
+        # hold back every event which might not be committed yet
+        write_id = self._mongo.db[EVENT_WRITES_COLLECTION].insert_one({'started_at': datetime.utcnow()}).inserted_id
+        try:
+            if len(events) == 1:
+                self._mongo.db[EVENTS_COLLECTION].insert_one(_event(*events[0]))
+            else:
+                self._mongo.db[EVENTS_COLLECTION].insert_many([_event(*e) for e in events], ordered=False)
+        finally:
+            self._mongo.db[EVENT_WRITES_COLLECTION].delete_one({'_id': write_id})
+
+    def join(self, collection, documents):
+        # sets the transitions and callbacks arrays of the given documents from the events collection
+        if not self.enabled:
+            return
+
+        documents = {d['_id']: d for d in documents if '_id' in d}
+        if not documents:
+            return
+
+        for d in documents.values():
+            d['transitions'] = []
+            if collection in ['application_containers', 'data_containers']:
+                d['callbacks'] = []
+
+        cursor = self._mongo.db[EVENTS_COLLECTION].find({
+            'meta.document_id': {'$in': list(documents)},
+            'meta.collection': collection
+        }, {'_id': 0, 'date': 0}).sort('date', ASCENDING)
+
+        for event in cursor:
+            meta = event.pop('meta')
+            key = 'transitions' if meta['event_type'] == 'transition' else 'callbacks'
+            documents[meta['document_id']][key].append(event)
+
+    def _committed_until(self):
+        # every event not committed yet belongs to a registered write and its ObjectId is not older than the start of
+        # the write. Events of seconds before the oldest running write are therefore complete. One more second is
+        # held back for clocks of different hosts being slightly apart
+        until = datetime.utcnow()
+        oldest_write = self._mongo.db[EVENT_WRITES_COLLECTION].find_one(
+            {'started_at': {'$gt': until - timedelta(seconds=FEED_LOOKBACK_SECONDS)}},
+            sort=[('started_at', ASCENDING)]
+        )
+        if oldest_write:
+            until = min(until, oldest_write['started_at'])
+        return ObjectId.from_datetime(until.replace(microsecond=0) - timedelta(seconds=1))
+
+    def feed(self, username, offset, limit):
+        # returns transitions after the offset, which is the _id of the last event received. Only committed events are
+        # returned, in the order of their ObjectIds, such that no event is below an offset already returned
+        until = self._committed_until()
+        query = {
+            'meta.event_type': 'transition',
+            '_id': {'$lt': until}
+        }
+        if username:
+            query['meta.username'] = username
+        if offset:
+            query['_id']['$gt'] = offset
+            since = offset.generation_time.replace(tzinfo=None) - timedelta(seconds=FEED_LOOKBACK_SECONDS)
+            query['date'] = {'$gte': since}
+
+        cursor = self._mongo.db[EVENTS_COLLECTION].find(query).sort('_id', ASCENDING).limit(limit)
+
+        result = []
+        for event in cursor:
+            meta = event.pop('meta')
+            del event['date']
+            event['offset'] = event.pop('_id')
+            event['collection'] = meta['collection']
+            event['_id'] = meta['document_id']
+            result.append(event)
+        return result
@@ -1,3 +1,5 @@
+import json
+import chardet
 from os import urandom
 from binascii import hexlify
 from bson.objectid import ObjectId
@@ -48,11 +50,33 @@ def prepare_input(data):
     return _prepare_input(data, False)
 
 
+def decode_data(data, charset=None):
+    # the charset of the Content-Type header is tried first, then the UTF-8, UTF-16 or UTF-32 encoding of the JSON
+    # standard, which is recognized by its first bytes. The slow character set detection is only a fallback for
+    # clients sending other encodings without declaring them
+    encodings = [json.detect_encoding(data)]
+    if charset:
+        encodings.insert(0, charset)
+
+    for encoding in encodings:
+        try:
+            return data.decode(encoding)
+        except (LookupError, UnicodeDecodeError):
+            pass
+
+    enc = chardet.detect(data)
+    return data.decode(enc['encoding'])
+
+
+def _is_secret(key):
+    return 'key' in key or 'password' in key
+
+
 def _prepare(data, replace_objectid, replace_secret):
     if isinstance(data, dict):
         result = {}
         for key, val in data.items():
-            if not replace_secret and ('key' in key or 'password' in key):
+            if not replace_secret and _is_secret(key):
                 result[key] = _prepare(val, replace_objectid, True)
             else:
                 result[key] = _prepare(val, replace_objectid, replace_secret)
@@ -75,6 +99,55 @@ def remove_secrets(data):
     return _prepare(data, False, False)
 
 
+def _join_path(path, key):
+    if path is None:
+        return key
+    return '{}.{}'.format(path, key)
+
+
+def _secret_paths(data, path, is_secret):
+    result = []
+    if isinstance(data, dict):
+        for key, val in data.items():
+            result += _secret_paths(val, _join_path(path, key), is_secret or _is_secret(key))
+    elif isinstance(data, list):
+        for i, e in enumerate(data):
+            result += _secret_paths(e, _join_path(path, str(i)), is_secret)
+    elif is_secret and not isinstance(data, ObjectId):
+        result.append(path)
+    return result
+
+
+def secret_paths(data):
+    # dotted paths of all values replaced by remove_secrets
+    return _secret_paths(data, None, False)
+
+
+def _schema_secret_paths(schema, path, is_secret):
+    result = []
+    if 'properties' in schema:
+        # optional properties are skipped, $set would create them in documents where they are missing
+        for key in schema.get('required', []):
+            result += _schema_secret_paths(
+                schema['properties'][key], _join_path(path, key), is_secret or _is_secret(key)
+            )
+    elif 'items' in schema:
+        result += _schema_secret_paths(schema['items'], _join_path(path, '$[]'), is_secret)
+    elif is_secret:
+        result.append(path)
+    return result
+
+
+def schema_secret_paths(schema):
+    # dotted paths of secret values present in every document valid against the given schema, array items as $[]
+    return _schema_secret_paths(schema, None, False)
+
+
+def scrub_secrets(paths):
+    # $set operation replacing the values of the given paths like remove_secrets
+    return {path: 10*'*' for path in paths}
+
+
 def close_sockets(sockets):
     for s in sockets:
         s.close()
@@ -1,6 +1,12 @@
-import requests
+import json
+from hashlib import sha256
+from time import time
+from urllib.parse import urlparse
 from requests.auth import HTTPBasicAuth, HTTPDigestAuth
-from traceback import format_exc
+
+from cc_server.commons.helper import prepare_response
+
+NOTIFICATIONS_COLLECTION = 'notifications'
 
 
 def _auth(http_auth):
@@ -22,22 +28,60 @@ def _auth(http_auth):
     raise Exception('Authorization information is not valid.')
 
 
-def notify(tee, servers, meta_data):
+def endpoint(url):
+    parsed = urlparse(url)
+    return '{}://{}'.format(parsed.scheme, parsed.netloc)
+
+
+def _batch_key(connector_access, add_meta_data, batch):
+    # notifications with equal keys are sent to the same server with the same request options and can be batched
+    data = json.dumps([connector_access, add_meta_data, batch], sort_keys=True, default=str)
+    return sha256(data.encode('utf-8')).hexdigest()
+
+
+def notify(mongo, servers, meta_data):
+    # notifications are stored in an outbox and sent by the notification delivery of cc-server-master
+    now = time()
+    notifications = []
     for server in servers:
         connector_access = server['connector_access']
-        try:
-            json_data = connector_access.get('json_data')
-            if connector_access.get('add_meta_data'):
-                json_data = connector_access.get('json_data', {})
-                for key, val in meta_data.items():
-                    json_data[key] = val
-
-            r = requests.post(
-                connector_access['url'],
-                json=json_data,
-                auth=_auth(connector_access.get('auth')),
-                verify=connector_access.get('ssl_verify', True)
-            )
-            r.raise_for_status()
-        except:
-            tee('Could not notify server {}: {}'.format(connector_access['url'], format_exc()))
+        add_meta_data = server.get('add_meta_data', connector_access.get('add_meta_data', False))
+        # servers receive batches only if they requested them, because batches are sent in a different format
+        batch = server.get('batch', False)
+        notifications.append({
+            'state': 'pending',
+            'endpoint': endpoint(connector_access['url']),
+            'batch': batch,
+            'batch_key': _batch_key(connector_access, add_meta_data, batch),
+            'connector_access': connector_access,
+            'add_meta_data': add_meta_data,
+            'meta_data': prepare_response(meta_data),
+            'trials': 0,
+            'created_at': now,
+            'next_attempt_at': now
+        })
+    if notifications:
+        mongo.db[NOTIFICATIONS_COLLECTION].insert_many(notifications)
+
+
+def send(session, notifications, timeout):
+    # a single notification merges its meta data into json_data, a batch sends the meta data of all notifications as
+    # list
+    connector_access = notifications[0]['connector_access']
+    json_data = connector_access.get('json_data')
+    if notifications[0]['add_meta_data']:
+        json_data = dict(connector_access.get('json_data', {}))
+        if len(notifications) > 1:
+            json_data['meta_data'] = [n['meta_data'] for n in notifications]
+        else:
+            for key, val in notifications[0]['meta_data'].items():
+                json_data[key] = val
+
+    r = session.post(
+        connector_access['url'],
+        json=json_data,
+        auth=_auth(connector_access.get('auth')),
+        verify=connector_access.get('ssl_verify', True),
+        timeout=timeout
+    )
+    r.raise_for_status()
@@ -56,7 +56,8 @@ _notification_connector_schema = {
             'required': ['url'],
             'additionalProperties': False
         },
-        'add_meta_data': {'type': 'boolean'}
+        'add_meta_data': {'type': 'boolean'},
+        'batch': {'type': 'boolean'}
     },
     'required': ['connector_access'],
     'additionalProperties': False
@@ -164,6 +165,28 @@ _sandbox_schema = {
     'additionalProperties': False
 }
 
+_parameters_schema = {
+    'anyOf': [
+        {'type': 'object'},
+        {'type': 'array'}
+    ]
+}
+
+_input_files_schema = {
+    'type': 'array',
+    'items': _input_connector_schema
+}
+
+_result_files_schema = {
+    'type': 'array',
+    'items': {
+        'anyOf': [
+            _result_connector_schema,
+            {'type': 'null'}
+        ]
+    }
+}
+
 _task_schema = {
     'type': 'object',
     'properties': {
@@ -193,29 +216,13 @@ _task_schema = {
                 'container_ram': {'type': 'number'},
                 'tracing': _tracing_schema,
                 'sandbox': _sandbox_schema,
-                'parameters': {
-                    'anyOf': [
-                        {'type': 'object'},
-                        {'type': 'array'}
-                    ]
-                }
+                'parameters': _parameters_schema
             },
             'required': ['image', 'container_ram'],
             'additionalProperties': False
         },
-        'input_files': {
-            'type': 'array',
-            'items': _input_connector_schema
-        },
-        'result_files': {
-            'type': 'array',
-            'items': {
-                'anyOf': [
-                    _result_connector_schema,
-                    {'type': 'null'}
-                ]
-            }
-        },
+        'input_files': _input_files_schema,
+        'result_files': _result_files_schema,
         'notifications': {
             'type': 'array',
             'items': _notification_connector_schema
@@ -235,16 +242,69 @@ _tasks_schema = {
         'tasks': {
             'type': 'array',
             'items': _task_schema
+        },
+        'notifications': {
+            'type': 'array',
+            'items': _notification_connector_schema
         }
     },
     'required': ['tasks'],
     'additionalProperties': False
 }
 
+_task_template_schema = {
+    'type': 'object',
+    'properties': {
+        'task_template': _task_schema,
+        'variations': {
+            'type': 'array',
+            'items': {
+                'type': 'object',
+                'properties': {
+                    'parameters': _parameters_schema,
+                    'input_files': _input_files_schema,
+                    'result_files': _result_files_schema
+                },
+                'additionalProperties': False
+            }
+        },
+        'product': {
+            'type': 'object',
+            'properties': {
+                'parameters': {
+                    'type': 'array',
+                    'items': _parameters_schema
+                },
+                'input_files': {
+                    'type': 'array',
+                    'items': _input_files_schema
+                },
+                'result_files': {
+                    'type': 'array',
+                    'items': _result_files_schema
+                }
+            },
+            'minProperties': 1,
+            'additionalProperties': False
+        },
+        'notifications': {
+            'type': 'array',
+            'items': _notification_connector_schema
+        }
+    },
+    'required': ['task_template'],
+    'oneOf': [
+        {'required': ['variations']},
+        {'required': ['product']}
+    ],
+    'additionalProperties': False
+}
+
 tasks_schema = {
     'anyOf': [
         _task_schema,
-        _tasks_schema
+        _tasks_schema,
+        _task_template_schema
     ]
 }
 
@@ -298,6 +358,38 @@ tasks_cancel_schema = {
     }]
 }
 
+_wait_ids = {
+    'type': 'array',
+    'items': {
+        'type': 'object',
+        'properties': {
+            '_id': {'type': 'string'}
+        },
+        'required': ['_id'],
+        'additionalProperties': False
+    }
+}
+
+tasks_wait_schema = {
+    'type': 'object',
+    'properties': {
+        'tasks': _wait_ids,
+        'timeout_seconds': {'type': 'number', 'minimum': 0}
+    },
+    'required': ['tasks'],
+    'additionalProperties': False
+}
+
+task_groups_wait_schema = {
+    'type': 'object',
+    'properties': {
+        'task_groups': _wait_ids,
+        'timeout_seconds': {'type': 'number', 'minimum': 0}
+    },
+    'required': ['task_groups'],
+    'additionalProperties': False
+}
+
 query_schema = {
     'type': 'object',
     'properties': {
@@ -383,7 +475,8 @@ query_schema = {
                     'additionalProperties': False
                 }]
             }
-        }
+        },
+        'join_history': {'type': 'boolean'}
     },
     'required': ['aggregate'],
     'additionalProperties': False
@@ -467,7 +560,32 @@ cc_server_config_schema = {
                 'external_url': {'type': 'string'},
                 'bind_host': {'type': 'string'},
                 'bind_port': {'type': 'integer'},
-                'num_workers': {'type': 'integer'}
+                'num_workers': {'type': 'integer'},
+                'event_feed': {
+                    'type': 'object',
+                    'properties': {
+                        'poll_interval_seconds': {'type': 'number'},
+                        'heartbeat_seconds': {'type': 'number'},
+                        'max_stream_seconds': {'type': 'number'},
+                        'batch_size': {'type': 'integer'}
+                    },
+                    'additionalProperties': False
+                },
+                'wait': {
+                    'type': 'object',
+                    'properties': {
+                        'poll_interval_seconds': {'type': 'number'},
+                        'max_timeout_seconds': {'type': 'number'}
+                    },
+                    'additionalProperties': False
+                },
+                'task_templates': {
+                    'type': 'object',
+                    'properties': {
+                        'max_tasks': {'type': 'integer'}
+                    },
+                    'additionalProperties': False
+                }
             },
             'required': ['external_url', 'bind_host', 'bind_port'],
             'additionalProperties': False
@@ -478,7 +596,50 @@ cc_server_config_schema = {
                 'external_url': {'type': 'string'},
                 'bind_host': {'type': 'string'},
                 'bind_port': {'type': 'integer'},
-                'scheduling_interval_seconds': {'type': 'integer'}
+                'scheduling_interval_seconds': {'type': 'integer'},
+                'cluster_provider': {'enum': ['docker', 'fake', 'local']},
+                'notifications': {
+                    'type': 'object',
+                    'properties': {
+                        'interval_seconds': {'type': 'number'},
+                        'timeout_seconds': {'type': 'number'},
+                        'max_retries': {'type': 'integer'},
+                        'retry_backoff_seconds': {'type': 'number'},
+                        'max_concurrent_deliveries': {'type': 'integer'},
+                        'max_concurrent_deliveries_per_endpoint': {'type': 'integer'},
+                        'batch_window_seconds': {'type': 'number'},
+                        'max_batch_size': {'type': 'integer'}
+                    },
+                    'additionalProperties': False
+                },
+                'container_reconciliation': {
+                    'type': 'object',
+                    'properties': {
+                        'full_sweep_interval_seconds': {'type': 'integer'}
+                    },
+                    'additionalProperties': False
+                },
+                'node_health': {
+                    'type': 'object',
+                    'properties': {
+                        'interval_seconds': {'type': 'integer'},
+                        'failure_threshold': {'type': 'integer'},
+                        'latency_threshold_ms': {'type': 'number'},
+                        'inspection_backoff_seconds': {'type': 'integer'},
+                        'max_inspection_backoff_seconds': {'type': 'integer'}
+                    },
+                    'additionalProperties': False
+                },
+                'image_pre_pulling': {
+                    'type': 'object',
+                    'properties': {
+                        'queue_depth': {'type': 'integer'},
+                        'interval_seconds': {'type': 'integer'},
+                        'max_concurrent_pulls_per_node': {'type': 'integer'},
+                        'max_disk_mb_per_node': {'type': 'integer'}
+                    },
+                    'additionalProperties': False
+                }
             },
             'required': ['external_url', 'bind_host', 'bind_port'],
             'additionalProperties': False
@@ -515,7 +676,15 @@ cc_server_config_schema = {
                 'password': {'type': 'string'},
                 'host': {'type': 'string'},
                 'port': {'type': 'integer'},
-                'db': {'type': 'string'}
+                'db': {'type': 'string'},
+                'events': {
+                    'type': 'object',
+                    'properties': {
+                        'enabled': {'type': 'boolean'},
+                        'time_series': {'type': 'boolean'}
+                    },
+                    'additionalProperties': False
+                }
             },
             'required': ['username', 'password', 'host', 'port', 'db'],
             'additionalProperties': False
@@ -525,8 +694,35 @@ cc_server_config_schema = {
             'properties': {
                 'thread_limit': {'type': 'integer'},
                 'api_timeout': {'type': 'integer'},
+                'node_startup_timeout_seconds': {'type': 'integer'},
                 'net': {'type': 'string'},
                 'docker_machine_dir': {'type': 'string'},
+                'events': {
+                    'type': 'object',
+                    'properties': {
+                        'enabled': {'type': 'boolean'},
+                        'reconcile_interval_seconds': {'type': 'integer'}
+                    },
+                    'required': ['enabled'],
+                    'additionalProperties': False
+                },
+                'garbage_collection': {
+                    'type': 'object',
+                    'properties': {
+                        'concurrency': {'type': 'integer'},
+                        'max_retries': {'type': 'integer'}
+                    },
+                    'additionalProperties': False
+                },
+                'image_refresh': {
+                    'type': 'object',
+                    'properties': {
+                        'policy': {'enum': ['always', 'if-missing', 'interval']},
+                        'interval_seconds': {'type': 'integer'}
+                    },
+                    'required': ['policy'],
+                    'additionalProperties': False
+                },
                 'nodes': {
                     'type': 'object',
                     'patternProperties': {
@@ -556,6 +752,30 @@ cc_server_config_schema = {
             'required': ['thread_limit'],
             'additionalProperties': False
         },
+        'fake_cluster': {
+            'type': 'object',
+            'properties': {
+                'num_nodes': {'type': 'integer'},
+                'node_ram': {'type': 'integer'},
+                'node_cpus': {'type': 'integer'},
+                'pull_seconds': {'type': 'number'},
+                'start_seconds': {'type': 'number'},
+                'run_seconds': {'type': 'number'},
+                'failure_rate': {'type': 'number', 'minimum': 0, 'maximum': 1},
+                'exit_failure_rate': {'type': 'number', 'minimum': 0, 'maximum': 1}
+            },
+            'additionalProperties': False
+        },
+        'local_cluster': {
+            'type': 'object',
+            'properties': {
+                'total_ram': {'type': 'integer'},
+                'total_cpus': {'type': 'integer'},
+                'work_dir': {'type': 'string'},
+                'cgroup_dir': {'type': 'string'}
+            },
+            'additionalProperties': False
+        },
         'defaults': {
             'type': 'object',
             'properties': {
@@ -574,6 +794,7 @@ cc_server_config_schema = {
                         'entry_point': {'type': 'string'},
                         'container_ram': {'type': 'integer'},
                         'num_workers': {'type': 'integer'},
+                        'warm_pool_size': {'type': 'integer'},
                         'registry_auth': {
                             'type': 'object',
                             'properties': {
@@ -1,7 +1,12 @@
 from time import time
+from bson.objectid import ObjectId
+from pymongo import ReturnDocument, UpdateOne
 
-from cc_server.commons.helper import remove_secrets
+from cc_server.commons.events import Events
+from cc_server.commons.helper import remove_secrets, schema_secret_paths, scrub_secrets
+from cc_server.commons.schemas import callback_schema
 from cc_server.commons.notification import notify
+from cc_server.commons.task_templates import TASK_TEMPLATES_COLLECTION
 
 STATES = [
     'created',
@@ -12,6 +17,19 @@ STATES = [
     'cancelled'         # end state
 ]
 
+_CONTAINER_SECRET_PATHS = ['callback_key'] + [
+    'callbacks.$[].{}'.format(path) for path in schema_secret_paths(callback_schema)
+]
+
+# secret paths known in advance, scrubbed by the end state transition itself
+SECRET_PATHS = {
+    'application_containers': _CONTAINER_SECRET_PATHS,
+    'data_containers': _CONTAINER_SECRET_PATHS + ['input_file_keys.$[]']
+}
+
+# secret paths depending on connectors and parameters are stored per document, see _remove_document_secrets
+DOCUMENT_SECRET_PATHS = ['tasks', 'task_groups', 'data_containers']
+
 
 # public functions
 def index_to_state(index):
@@ -53,6 +71,10 @@ class StateHandler:
         self._config = config
         self._tee = tee
         self._mongo = mongo
+        self._events = Events(
+            config=config,
+            mongo=mongo
+        )
 
     def transition(self, collection, _id, state, description, exception=None):
         if collection == 'tasks':
@@ -66,32 +88,293 @@ class StateHandler:
         else:
             raise Exception('Invalid collection: %s' % collection)
 
-    def _task_group_transition(self, task_group_id, state, description, exception, caused_by):
-        task_group = self._mongo.db['task_groups'].find_one(
-            {'_id': task_group_id},
-            {'state': 1}
+    def insert_many(self, collection, documents, states):
+        # inserts new documents with their initial transitions, a list of (state, description), in a single write
+        # instead of one insert and one update per transition
+        initial_transitions = []
+        for document in documents:
+            ts = [transition(state, description, None, None) for state, description in states]
+            initial_transitions.append(ts)
+            document['state'] = ts[-1]['state']
+            for t in ts:
+                if is_state(t['state'], 'created'):
+                    document['created_at'] = t['timestamp']
+            document['transitions'] = [] if self._events.enabled else ts
+
+        ids = self._mongo.db[collection].insert_many(documents).inserted_ids
+
+        events = []
+        for _id, document, ts in zip(ids, documents, initial_transitions):
+            for t in ts:
+                self._log_transition(collection, _id, t)
+                events.append((collection, _id, 'transition', t, document.get('username')))
+
+        if self._events.enabled and events:
+            self._events.append_many(events)
+
+        return ids
+
+    def transition_many(self, entries):
+        # entries are tuples of (collection, _id, state, description), cascades from containers to tasks and task
+        # groups are evaluated in memory and written with one bulk write per collection
+        if not entries:
+            return
+
+        batch = {
+            'data_containers': {},
+            'application_containers': {},
+            'tasks': {},
+            'task_groups': {}
+        }
+        entries = [(collection, _id, state, description, None) for collection, _id, state, description in entries]
+
+        for collection, _id, state, description, caused_by in entries:
+            if collection not in batch:
+                raise Exception('Invalid collection: %s' % collection)
+
+        def select(collection):
+            return [e for e in entries if e[0] == collection]
+
+        # data containers
+        failed_data_containers = {}
+        self._load_batch(batch, 'data_containers', [e[1] for e in select('data_containers')], {'state': 1})
+        for collection, _id, state, description, caused_by in select('data_containers'):
+            if self._batch_transition(batch, collection, _id, state, description, caused_by) and state == 'failed':
+                failed_data_containers[_id] = description
+
+        application_container_entries = select('application_containers')
+
+        if failed_data_containers:
+            cursor = self._mongo.db['application_containers'].find({
+                'state': {'$nin': end_states()},
+                'data_container_ids': {'$in': list(failed_data_containers)}
+            }, {'data_container_ids': 1})
+            for application_container in cursor:
+                for data_container_id in application_container['data_container_ids']:
+                    if data_container_id in failed_data_containers:
+                        ac_description = 'Application container failed: %s' % failed_data_containers[data_container_id]
+                        application_container_entries.append((
+                            'application_containers', application_container['_id'], 'failed', ac_description,
+                            {'data_container_id': data_container_id}
+                        ))
+                        break
+
+        cancelled_tasks = {e[1]: e[3] for e in select('tasks') if e[2] == 'cancelled'}
+        if cancelled_tasks:
+            cursor = self._mongo.db['application_containers'].find({
+                'state': {'$nin': end_states()},
+                'task_id': {'$in': list(cancelled_tasks)}
+            }, {'task_id': 1})
+            for application_container in cursor:
+                task_id = application_container['task_id'][0]
+                ac_description = 'Application container cancelled: %s' % cancelled_tasks[task_id]
+                application_container_entries.append((
+                    'application_containers', application_container['_id'], 'cancelled', ac_description,
+                    {'task_id': task_id}
+                ))
+
+        # application containers
+        task_entries = select('tasks')
+        self._load_batch(
+            batch, 'application_containers', [e[1] for e in application_container_entries], {'state': 1, 'task_id': 1}
+        )
+        for collection, _id, state, description, caused_by in application_container_entries:
+            if not self._batch_transition(batch, collection, _id, state, description, caused_by):
+                continue
+            task_state = {'created': 'processing', 'failed': 'failed', 'success': 'success'}.get(state)
+            if task_state:
+                task_id = batch[collection][_id]['task_id'][0]
+                task_entries.append(('tasks', task_id, task_state, description, {'application_container_id': _id}))
+
+        # tasks
+        task_group_entries = select('task_groups')
+        self._load_batch(
+            batch, 'tasks', [e[1] for e in task_entries], {'state': 1, 'trials': 1, 'task_group_id': 1}
         )
+        max_task_trials = self._config.defaults['error_handling']['max_task_trials']
+        for collection, _id, state, description, caused_by in task_entries:
+            task = batch[collection].get(_id)
+            if not task or task['state'] in end_states():
+                continue
 
-        if task_group['state'] in end_states():
-            return
+            if state == 'failed':
+                task['inc_trials'] += 1
+                trials = task['trials'] + task['inc_trials']
+                if trials < max_task_trials:
+                    state = 'waiting'
+                    description = 'Task waiting again (trial {} of {}): {}'.format(
+                        trials, max_task_trials, description
+                    )
+
+            self._batch_transition(batch, collection, _id, state, description, caused_by)
+
+            if state == 'processing':
+                task_group_entries.append((
+                    'task_groups', task['task_group_id'][0], 'processing', 'Task group processing.', {'task_id': _id}
+                ))
+
+        # task groups
+        self._load_batch(batch, 'task_groups', [e[1] for e in task_group_entries], {'state': 1})
+        for collection, _id, state, description, caused_by in task_group_entries:
+            task_group = batch[collection].get(_id)
+            if not task_group:
+                continue
+            if state == 'processing' and caused_by and not is_state(task_group['state'], 'waiting'):
+                continue
+            if task_group['state'] == state_to_index(state):
+                continue
+            if self._batch_transition(batch, collection, _id, state, description, caused_by) and caused_by:
+                task_group['state_filter'] = {'$in': [state_to_index('waiting')]}
 
-        if state_to_index(state) == task_group['state']:
+        self._write_batch(batch)
+
+    def _load_batch(self, batch, collection, ids, projection):
+        ids = [_id for _id in set(ids) if _id not in batch[collection]]
+        if not ids:
             return
+        cursor = self._mongo.db[collection].find({'_id': {'$in': ids}}, projection)
+        for doc in cursor:
+            doc['transitions'] = []
+            doc['inc_trials'] = 0
+            batch[collection][doc['_id']] = doc
+
+    @staticmethod
+    def _batch_transition(batch, collection, _id, state, description, caused_by):
+        doc = batch[collection].get(_id)
+        if not doc or doc['state'] in end_states():
+            return False
+        t = transition(state, description, None, caused_by)
+        doc['state'] = t['state']
+        doc['transitions'].append(t)
+        return True
+
+    def _write_batch(self, batch):
+        batch_id = ObjectId()
+        finished_tasks = {}
+
+        for collection, docs in batch.items():
+            docs = {_id: doc for _id, doc in docs.items() if doc['transitions']}
+            if not docs:
+                continue
 
-        t = transition(state, description, exception, caused_by)
-        self._append_transition('task_groups', task_group_id, t)
+            requests = []
+            for _id, doc in docs.items():
+                ts = doc['transitions']
+                update = {
+                    '$set': {'state': doc['state'], 'transition_batch_id': batch_id}
+                }
+                if not self._events.enabled:
+                    update['$push'] = {'transitions': {'$each': ts}}
+                for t in ts:
+                    if is_state(t['state'], 'created'):
+                        update['$set']['created_at'] = t['timestamp']
+                if doc['state'] in end_states():
+                    update['$set']['finished_at'] = ts[-1]['timestamp']
+                if doc['inc_trials']:
+                    update['$inc'] = {'trials': doc['inc_trials']}
+                if doc['state'] in end_states() and collection in SECRET_PATHS:
+                    update['$set'].update(scrub_secrets(SECRET_PATHS[collection]))
+
+                state_filter = doc.get('state_filter', {'$nin': end_states()})
+                requests.append(UpdateOne({'_id': _id, 'state': state_filter}, update))
+
+            self._mongo.db[collection].bulk_write(requests, ordered=False)
+
+            # documents changed concurrently by other transitions are not part of the batch
+            projection = {'username': 1}
+            if collection == 'data_containers':
+                projection = {'username': 1, 'secret_paths': 1}
+            if collection in ['tasks', 'task_groups']:
+                projection = {
+                    'username': 1, 'notifications': 1, 'task_group_id': 1, 'secret_paths': 1, 'task_template_id': 1
+                }
+            cursor = self._mongo.db[collection].find(
+                {'_id': {'$in': list(docs)}, 'transition_batch_id': batch_id},
+                projection
+            )
 
-    def _application_container_transition(self, application_container_id, state, description, exception, caused_by):
-        application_container = self._mongo.db['application_containers'].find_one(
-            {'_id': application_container_id},
-            {'task_id': 1, 'state': 1}
+            events = []
+            # the batch tag is only needed to find the applied transitions, it is removed in the same write that
+            # scrubs secrets
+            cleanup_requests = []
+            for data in cursor:
+                doc = docs[data['_id']]
+                cleanup = {'$unset': {'transition_batch_id': ''}}
+                for t in doc['transitions']:
+                    self._log_transition(collection, data['_id'], t)
+                    events.append((collection, data['_id'], 'transition', t, data.get('username')))
+
+                if collection in ['tasks', 'task_groups'] and doc['state'] in end_states():
+                    if data.get('notifications'):
+                        meta_data = {'task_id' if collection == 'tasks' else 'task_group_id': data['_id']}
+                        notify(self._mongo, data['notifications'], meta_data)
+                    if collection == 'task_groups' and data.get('task_template_id'):
+                        self._remove_task_template_secrets(data['task_template_id'])
+
+                if collection in DOCUMENT_SECRET_PATHS and doc['state'] in end_states():
+                    if data.get('secret_paths'):
+                        cleanup['$set'] = scrub_secrets(data['secret_paths'])
+                    elif 'secret_paths' not in data:
+                        self._remove_document_secrets(collection, data['_id'], data)
+
+                if collection == 'tasks' and doc['state'] in end_states():
+                    counts = finished_tasks.setdefault(data['task_group_id'][0], [0, 0, data['_id']])
+                    counts[0] += 1
+                    if is_state(doc['state'], 'success'):
+                        counts[1] += 1
+
+                cleanup_requests.append(UpdateOne({'_id': data['_id'], 'transition_batch_id': batch_id}, cleanup))
+
+            if cleanup_requests:
+                self._mongo.db[collection].bulk_write(cleanup_requests, ordered=False)
+
+            if self._events.enabled and events:
+                self._events.append_many(events)
+
+        for task_group_id, (finished, succeeded, task_id) in finished_tasks.items():
+            self._count_finished_tasks(task_group_id, finished, succeeded, task_id)
+
+    def _task_group_transition(self, task_group_id, state, description, exception, caused_by, current_states=None):
+        state_filter = {'$nin': end_states() + [state_to_index(state)]}
+        if current_states:
+            state_filter = {'$in': [state_to_index(s) for s in current_states]}
+
+        t = transition(state, description, exception, caused_by)
+        task_group = self._append_transition(
+            'task_groups', task_group_id, t, projection={'notifications': 1, 'task_template_id': 1},
+            state_filter=state_filter
         )
 
-        if application_container['state'] in end_states():
+        if not task_group or state_to_index(state) not in end_states():
             return
 
+        if task_group.get('notifications'):
+            meta_data = {'task_group_id': task_group_id}
+            notify(self._mongo, task_group['notifications'], meta_data)
+
+        if task_group.get('task_template_id'):
+            self._remove_task_template_secrets(task_group['task_template_id'])
+
+    def _remove_task_template_secrets(self, task_template_id):
+        # the template is shared by all tasks of the group and keeps its secrets until the group has finished
+        task_template = self._mongo.db[TASK_TEMPLATES_COLLECTION].find_one(
+            {'_id': task_template_id},
+            {'secret_paths': 1}
+        )
+        if task_template and task_template['secret_paths']:
+            self._mongo.db[TASK_TEMPLATES_COLLECTION].update_one(
+                {'_id': task_template_id},
+                {'$set': scrub_secrets(task_template['secret_paths'])}
+            )
+
+    def _application_container_transition(self, application_container_id, state, description, exception, caused_by):
         t = transition(state, description, exception, caused_by)
-        self._append_transition('application_containers', application_container_id, t)
+        application_container = self._append_transition(
+            'application_containers', application_container_id, t, projection={'task_id': 1}
+        )
+
+        if not application_container:
+            return
 
         task_id = application_container['task_id'][0]
 
@@ -110,7 +393,52 @@ class StateHandler:
                 task_id, 'success', description, None, {'application_container_id': application_container_id}
             )
 
-    def _append_transition(self, collection, _id, t):
+    def _append_transition(self, collection, _id, t, projection=None, state_filter=None):
+        # the state precondition is part of the filter, a transition of a document that has been moved to an end
+        # state concurrently is not applied and None is returned
+        if state_filter is None:
+            state_filter = {'$nin': end_states()}
+
+        update = {
+            '$set': {'state': t['state']}
+        }
+        if not self._events.enabled:
+            update['$push'] = {'transitions': t}
+        if is_state(t['state'], 'created'):
+            update['$set']['created_at'] = t['timestamp']
+
+        projection = dict(projection or {})
+        projection['username'] = 1
+
+        is_end_state = t['state'] in end_states()
+        if is_end_state:
+            update['$set']['finished_at'] = t['timestamp']
+            if collection in SECRET_PATHS:
+                update['$set'].update(scrub_secrets(SECRET_PATHS[collection]))
+            if collection in DOCUMENT_SECRET_PATHS:
+                projection['secret_paths'] = 1
+
+        data = self._mongo.db[collection].find_one_and_update(
+            {'_id': _id, 'state': state_filter},
+            update,
+            projection=projection,
+            return_document=ReturnDocument.AFTER
+        )
+
+        if not data:
+            return None
+
+        if self._events.enabled:
+            self._events.append(collection, _id, 'transition', t, data.get('username'))
+
+        self._log_transition(collection, _id, t)
+
+        if is_end_state and collection in DOCUMENT_SECRET_PATHS:
+            self._remove_document_secrets(collection, _id, data)
+
+        return data
+
+    def _log_transition(self, collection, _id, t):
         if is_state(t['state'], 'failed'):
             self._tee('{} {} {} {} {}'.format(
                 collection, _id, index_to_state(t['state']), t['description'], t.get('exception'))
@@ -118,46 +446,49 @@ class StateHandler:
         else:
             self._tee('{} {} {}'.format(collection, _id, index_to_state(t['state'])))
 
-        if is_state(t['state'], 'created'):
-            self._mongo.db[collection].update({'_id': _id}, {
-                '$push': {'transitions': t},
-                '$set': {
-                    'state': t['state'],
-                    'created_at': t['timestamp']
-                }
-            })
-        else:
-            self._mongo.db[collection].update({'_id': _id}, {
-                '$push': {'transitions': t},
-                '$set': {'state': t['state']}
-            })
-        if t['state'] in end_states():
-            data = self._mongo.db[collection].find_one({'_id': _id})
-            del data['_id']
-            data = remove_secrets(data)
-            self._mongo.db[collection].update_one({'_id': _id}, {'$set': data})
-
-    def _task_transition(self, task_id, state, description, exception, caused_by):
-        task = self._mongo.db['tasks'].find_one(
-            {'_id': task_id},
-            {'trials': 1, 'notifications': 1, 'state': 1, 'task_group_id': 1}
-        )
-
-        if task['state'] in end_states():
+    def _remove_document_secrets(self, collection, _id, data):
+        # the secret paths of tasks, task groups and data containers depend on their connectors and parameters, they
+        # are recorded when the documents are created
+        if 'secret_paths' in data:
+            if data['secret_paths']:
+                self._mongo.db[collection].update_one(
+                    {'_id': _id},
+                    {'$set': scrub_secrets(data['secret_paths'])}
+                )
             return
 
+        data = self._mongo.db[collection].find_one({'_id': _id})
+        del data['_id']
+        data = remove_secrets(data)
+        self._mongo.db[collection].update_one({'_id': _id}, {'$set': data})
+
+    def _task_transition(self, task_id, state, description, exception, caused_by):
         if state == 'failed':
-            trials = task['trials'] + 1
-            self._mongo.db['tasks'].update_one(
-                {'_id': task_id},
-                {'$set': {'trials': trials}}
+            task = self._mongo.db['tasks'].find_one_and_update(
+                {'_id': task_id, 'state': {'$nin': end_states()}},
+                {'$inc': {'trials': 1}},
+                projection={'trials': 1},
+                return_document=ReturnDocument.AFTER
             )
+
+            if not task:
+                return
+
+            trials = task['trials']
             max_task_trials = self._config.defaults['error_handling']['max_task_trials']
 
             if trials < max_task_trials:
                 state = 'waiting'
                 description = 'Task waiting again (trial {} of {}): {}'.format(trials, max_task_trials, description)
 
+        t = transition(state, description, exception, caused_by)
+        task = self._append_transition(
+            'tasks', task_id, t, projection={'notifications': 1, 'task_group_id': 1}
+        )
+
+        if not task:
+            return
+
         if state == 'cancelled':
             application_containers = self._mongo.db['application_containers'].find({
                 'state': {'$nin': end_states()},
@@ -171,66 +502,83 @@ class StateHandler:
                     ac_id, 'cancelled', ac_description, None, {'task_id': task_id}
                 )
 
-        t = transition(state, description, exception, caused_by)
-        self._append_transition('tasks', task_id, t)
-
         if state == 'processing':
-            task_group = self._mongo.db['task_groups'].find_one(
-                {'_id': task['task_group_id'][0], 'state': state_to_index('waiting')},
-                {'_id': 1}
+            description = 'Task group processing.'
+            self._task_group_transition(
+                task['task_group_id'][0], 'processing', description, None, {'task_id': task_id},
+                current_states=['waiting']
             )
-            if task_group:
-                description = 'Task group processing.'
-                self._task_group_transition(
-                    task['task_group_id'][0], 'processing', description, None, {'task_id': task_id}
-                )
 
         if state_to_index(state) in end_states():
             if task.get('notifications'):
                 meta_data = {'task_id': task_id}
-                notify(self._tee, task['notifications'], meta_data)
+                notify(self._mongo, task['notifications'], meta_data)
+
+            self._count_finished_tasks(task['task_group_id'][0], 1, 1 if state == 'success' else 0, task_id)
 
-    def update_task_groups(self):
-        task_groups = self._mongo.db['task_groups'].find(
-            {'state': {'$nin': end_states()}},
-            {'task_ids': 1, 'tasks_count': 1}
+    def _count_finished_tasks(self, task_group_id, finished, succeeded, task_id):
+        # every task reaches an end state only once, because transitions are conditional
+        task_group = self._mongo.db['task_groups'].find_one_and_update(
+            {'_id': task_group_id, 'finished_count': {'$exists': True}},
+            {'$inc': {'finished_count': finished, 'success_count': succeeded}},
+            projection={'tasks_count': 1, 'finished_count': 1, 'success_count': 1},
+            return_document=ReturnDocument.AFTER
         )
-        for task_group in task_groups:
-            tasks = self._mongo.db['tasks'].find(
-                {
-                    '_id': {'$in': task_group['task_ids']},
-                    'state': {'$in': end_states()}
-                },
-                {'_id': 1}
-            )
-            tasks = list(tasks)
-            if task_group['tasks_count'] != len(tasks):
-                continue
-            task = self._mongo.db['tasks'].find_one(
-                {
-                    '_id': {'$in': task_group['task_ids']},
-                    'state': state_to_index('success')
-                },
-                {'_id': 1}
-            )
-            if task:
-                description = 'All tasks in group finished.'
-                self._task_group_transition(task_group['_id'], 'success', description, None, None)
-                continue
-            description = 'All tasks in group failed or have been cancelled.'
-            self._task_group_transition(task_group['_id'], 'failed', description, None, None)
 
-    def _data_container_transition(self, data_container_id, state, description, exception, caused_by):
-        data_container = self._mongo.db['data_containers'].find_one(
-            {'_id': data_container_id},
-            {'state': 1}
+        if not task_group:
+            task_group = self._recount_finished_tasks(task_group_id)
+
+        self._finish_task_group(task_group, {'task_id': task_id})
+
+    def backfill_task_group_counters(self):
+        # task groups submitted before the counters were introduced are counted once from their tasks
+        cursor = self._mongo.db['task_groups'].find(
+            {'state': {'$nin': end_states()}, 'finished_count': {'$exists': False}},
+            {'_id': 1}
         )
+        for task_group in cursor:
+            self._finish_task_group(self._recount_finished_tasks(task_group['_id']), None)
+
+    def _recount_finished_tasks(self, task_group_id):
+        cursor = self._mongo.db['tasks'].aggregate([
+            {'$match': {'task_group_id': task_group_id, 'state': {'$in': end_states()}}},
+            {'$group': {'_id': '$state', 'count': {'$sum': 1}}}
+        ])
+        counts = {c['_id']: c['count'] for c in cursor}
+
+        # tasks_count has been set on submission since before the counters, older groups count their task_ids
+        task_group = self._mongo.db['task_groups'].find_one({'_id': task_group_id}, {'task_ids': 1, 'tasks_count': 1})
+        self._mongo.db['task_groups'].update_one({'_id': task_group_id, 'finished_count': {'$exists': False}}, {
+            '$set': {
+                'tasks_count': task_group.get('tasks_count', len(task_group.get('task_ids', []))),
+                'finished_count': sum(counts.values()),
+                'success_count': counts.get(state_to_index('success'), 0)
+            }
+        })
+
+        return self._mongo.db['task_groups'].find_one(
+            {'_id': task_group_id},
+            {'tasks_count': 1, 'finished_count': 1, 'success_count': 1}
+        )
+
+    def _finish_task_group(self, task_group, caused_by):
+        if not task_group['tasks_count'] or task_group['finished_count'] < task_group['tasks_count']:
+            return
 
-        if data_container['state'] in end_states():
+        if task_group['success_count']:
+            description = 'All tasks in group finished.'
+            self._task_group_transition(task_group['_id'], 'success', description, None, caused_by)
             return
 
+        description = 'All tasks in group failed or have been cancelled.'
+        self._task_group_transition(task_group['_id'], 'failed', description, None, caused_by)
+
+    def _data_container_transition(self, data_container_id, state, description, exception, caused_by):
         t = transition(state, description, exception, caused_by)
-        self._append_transition('data_containers', data_container_id, t)
+        data_container = self._append_transition('data_containers', data_container_id, t)
+
+        if not data_container:
+            return
 
         if state == 'failed':
             application_containers = self._mongo.db['application_containers'].find({
@@ -244,6 +592,3 @@ class StateHandler:
                 self._application_container_transition(
                     ac_id, 'failed', ac_description, None, {'data_container_id': data_container_id}
                 )
-
-
-
@@ -0,0 +1,68 @@
+from functools import reduce
+from itertools import product
+from operator import mul
+
+TASK_TEMPLATES_COLLECTION = 'task_templates'
+
+VARIATION_KEYS = ['parameters', 'input_files', 'result_files']
+
+
+def template_tasks_count(json_input):
+    if 'variations' in json_input:
+        return len(json_input['variations'])
+    return reduce(mul, [len(values) for values in json_input['product'].values()], 1)
+
+
+def _variations(json_input):
+    if 'variations' in json_input:
+        for variation in json_input['variations']:
+            yield variation
+        return
+
+    # the cartesian product of all given variation lists
+    keys = [key for key in VARIATION_KEYS if key in json_input['product']]
+    for values in product(*[json_input['product'][key] for key in keys]):
+        yield dict(zip(keys, values))
+
+
+def expand_task_template(json_input):
+    # the application_container_description of the template is stored once in the task_templates collection, the
+    # tasks only contain their parameters and the fields of the template they do not vary
+    template = {
+        key: val for key, val in json_input['task_template'].items() if key != 'application_container_description'
+    }
+    tasks = []
+    for variation in _variations(json_input):
+        task = dict(template)
+        for key in ['input_files', 'result_files']:
+            if key in variation:
+                task[key] = variation[key]
+        if 'parameters' in variation:
+            task['application_container_description'] = {'parameters': variation['parameters']}
+        tasks.append(task)
+    return tasks
+
+
+def resolve_task_template(mongo, task, templates=None):
+    # sets the complete application_container_description of a task created from a task template, templates is an
+    # optional dict caching the descriptions loaded by template _id
+    task_template_id = task.get('task_template_id')
+    if not task_template_id:
+        return task
+
+    if templates is None:
+        templates = {}
+
+    description = templates.get(task_template_id)
+    if description is None:
+        task_template = mongo.db[TASK_TEMPLATES_COLLECTION].find_one(
+            {'_id': task_template_id},
+            {'application_container_description': 1}
+        )
+        description = task_template['application_container_description']
+        templates[task_template_id] = description
+
+    description = dict(description)
+    description.update(task.get('application_container_description', {}))
+    task['application_container_description'] = description
+    return task
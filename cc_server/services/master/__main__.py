@@ -4,9 +4,15 @@ import zmq
 
 from cc_server.commons.configuration import Config
 from cc_server.commons.database import Mongo
+from cc_server.commons.events import Events
 from cc_server.commons.states import StateHandler
 from cc_server.services.master.cluster import Cluster
 from cc_server.services.master.cluster_provider import DockerProvider
+from cc_server.services.master.fake_cluster_provider import FakeProvider
+from cc_server.services.master.local_cluster_provider import LocalProcessProvider
+from cc_server.services.master.node_health import NodeHealthMonitor
+from cc_server.services.master.notification_delivery import NotificationDelivery
+from cc_server.services.master.pre_pulling import ImagePrePuller
 from cc_server.services.master.scheduling import Scheduler
 from cc_server.services.master.worker import Worker
 
@@ -31,16 +37,34 @@ def main():
     mongo = Mongo(
         config=config
     )
-    state_handler = StateHandler(
+    Events(
         config=config,
-        tee=tee,
         mongo=mongo
-    )
-    cluster_provider = DockerProvider(
+    ).create_collection()
+    state_handler = StateHandler(
         config=config,
         tee=tee,
         mongo=mongo
     )
+    state_handler.backfill_task_group_counters()
+    if config.server_master.get('cluster_provider') == 'fake':
+        cluster_provider = FakeProvider(
+            config=config,
+            tee=tee,
+            mongo=mongo
+        )
+    elif config.server_master.get('cluster_provider') == 'local':
+        cluster_provider = LocalProcessProvider(
+            config=config,
+            tee=tee,
+            mongo=mongo
+        )
+    else:
+        cluster_provider = DockerProvider(
+            config=config,
+            tee=tee,
+            mongo=mongo
+        )
     cluster = Cluster(
         config=config,
         tee=tee,
@@ -63,6 +87,27 @@ def main():
         cluster=cluster,
         scheduler=scheduler
     )
+    cluster_provider.set_container_exit_handler(worker.schedule)
+    node_health_monitor = NodeHealthMonitor(
+        config=config,
+        tee=tee,
+        mongo=mongo,
+        cluster=cluster
+    )
+
+    NotificationDelivery(
+        config=config,
+        tee=tee,
+        mongo=mongo
+    )
+
+    if config.server_master.get('image_pre_pulling'):
+        ImagePrePuller(
+            config=config,
+            tee=tee,
+            cluster=cluster,
+            scheduler=scheduler
+        )
 
     # inform at exit
     def at_exit():
@@ -89,7 +134,7 @@ def main():
         elif action == 'update_node_status':
             node_name = d.get('data', {}).get('node_name')
             if node_name:
-                pass
+                node_health_monitor.request_inspection(node_name)
 
 
 if __name__ == '__main__':
@@ -1,11 +1,18 @@
 import json
-import os
-from threading import Lock, Thread
+from threading import Lock, Thread, Event
 from traceback import format_exc
+from time import time
 from bson.objectid import ObjectId
 
+from cc_server.commons.helper import generate_secret
 from cc_server.commons.states import state_to_index, end_states
 from cc_server.commons.notification import notify
+from cc_server.services.master.node_health import DEGRADED, OFFLINE
+
+VANISHED_DESCRIPTION = 'Container vanished.'
+
+# containers which reached an end state up to this long before the previous clean up are checked by incremental sweeps
+FINISHED_LOOKBACK_SECONDS = 60
 
 
 class Cluster:
@@ -17,6 +24,14 @@ class Cluster:
         self._cluster_provider = cluster_provider
 
         self._data_container_lock = Lock()
+        self._data_container_pool_lock = Lock()
+
+        self._seen_containers = {}
+        self._last_full_sweep = 0
+        self._last_sweep = 0
+
+        for collection in ['application_containers', 'data_containers']:
+            self._mongo.db[collection].create_index('finished_at', sparse=True)
 
         self._create_nodes_on_startup()
 
@@ -26,18 +41,34 @@ class Cluster:
         except:
             pass
 
+    def ping(self, node_name):
+        return self._cluster_provider.ping(node_name)
+
+    def images(self, node_name):
+        try:
+            return self._cluster_provider.images(node_name)
+        except:
+            return {}
+
     def create_container(self, container_id, collection):
-        node_name = self._lookup_node_name(container_id, collection)
+        container = self._mongo.db[collection].find_one(
+            {'_id': container_id},
+            {'cluster_node': 1, 'pooled': 1}
+        )
+        node_name = container['cluster_node']
         try:
-            self._cluster_provider.create_container(container_id, collection)
+            if not container.get('pooled'):
+                self._cluster_provider.create_container(container_id, collection)
             description = 'Container waiting.'
             self._state_handler.transition(collection, container_id, 'waiting', description)
+            return True
         except:
             description = 'Container creation failed.'
             if not self.update_node(node_name):
                 description = 'Container creation failed due to node {} being offline.'.format(node_name)
             self._state_handler.transition(collection, container_id, 'failed', description, exception=format_exc())
             self._cluster_provider.remove_container(node_name, container_id)
+        return False
 
     def start_container(self, container_id, collection):
         node_name = self._lookup_node_name(container_id, collection)
@@ -66,13 +97,16 @@ class Cluster:
             files = task['input_files']
             data_container_ids = []
             for f in files:
+                # state -1 with a node assigned: scheduled in the current round, the created transition is pending
                 data_container = self._mongo.db['data_containers'].find_one(
                     {
                         'state': {'$in': [
+                            -1,
                             state_to_index('created'),
                             state_to_index('waiting'),
                             state_to_index('processing')
                         ]},
+                        'cluster_node': {'$ne': None},
                         'input_files': f
                     }, {'_id': 1}
                 )
@@ -85,36 +119,151 @@ class Cluster:
                 '$set': {'data_container_ids': data_container_ids}
             })
 
+    def claim_pooled_data_container(self, data_container_id, node_name):
+        # replaces the data container with a pre-created container from the warm pool of the node
+        pooled = self._mongo.db['data_container_pool'].find_one_and_delete({'cluster_node': node_name})
+        if not pooled:
+            return data_container_id
+
+        with self._data_container_lock:
+            data_container = self._mongo.db['data_containers'].find_one({'_id': data_container_id})
+            data_container['_id'] = pooled['_id']
+            data_container['callback_key'] = pooled['callback_key']
+            data_container['cluster_node'] = node_name
+            data_container['pooled'] = True
+            self._mongo.db['data_containers'].insert_one(data_container)
+
+            application_containers = self._mongo.db['application_containers'].find(
+                {'data_container_ids': data_container_id},
+                {'data_container_ids': 1}
+            )
+            for application_container in application_containers:
+                data_container_ids = [
+                    pooled['_id'] if val == data_container_id else val
+                    for val in application_container['data_container_ids']
+                ]
+                self._mongo.db['application_containers'].update_one(
+                    {'_id': application_container['_id']},
+                    {'$set': {'data_container_ids': data_container_ids}}
+                )
+
+            self._mongo.db['data_containers'].delete_one({'_id': data_container_id})
+
+        return pooled['_id']
+
+    def fill_data_container_pool(self):
+        pool_size = self._config.defaults['data_container_description'].get('warm_pool_size')
+        if not pool_size:
+            return
+
+        if not self._data_container_pool_lock.acquire(blocking=False):
+            return
+
+        try:
+            # nodes with an open circuit breaker are still online until their inspection has finished
+            nodes = self._mongo.db['nodes'].find(
+                {'is_online': True, 'status': {'$nin': [DEGRADED, OFFLINE]}},
+                {'cluster_node': 1}
+            )
+            threads = []
+            for node in nodes:
+                t = Thread(target=self._fill_data_container_pool, args=(node['cluster_node'], pool_size))
+                t.start()
+                threads.append(t)
+            for t in threads:
+                t.join()
+        finally:
+            self._data_container_pool_lock.release()
+
+    def _fill_data_container_pool(self, node_name, pool_size):
+        # pooled containers which disappeared from the cluster are removed by _prune_data_container_pool
+        num_pooled = len(list(self._mongo.db['data_container_pool'].find({'cluster_node': node_name}, {'_id': 1})))
+
+        if num_pooled >= pool_size:
+            return
+
+        self.update_image(
+            node_name,
+            self._config.defaults['data_container_description']['image'],
+            self._config.defaults['data_container_description'].get('registry_auth')
+        )
+
+        for _ in range(pool_size - num_pooled):
+            pooled_container_id = self._mongo.db['data_container_pool'].insert_one({
+                'cluster_node': node_name,
+                'callback_key': generate_secret(),
+                'created_at': time()
+            }).inserted_id
+            try:
+                self._cluster_provider.create_container(pooled_container_id, 'data_container_pool')
+            except:
+                self._tee('Could not fill data container pool on node {}: {}'.format(node_name, format_exc()))
+                self._mongo.db['data_container_pool'].delete_one({'_id': pooled_container_id})
+                self._cluster_provider.remove_container(node_name, pooled_container_id)
+                break
+
+    def _prune_data_container_pool(self, containers):
+        # pooled containers which disappeared from the cluster are found with the container listing of the clean up
+        pooled = self._mongo.db['data_container_pool'].find({}, {'_id': 1})
+        missing = [p['_id'] for p in pooled if str(p['_id']) not in containers]
+        if missing:
+            self._mongo.db['data_container_pool'].delete_many({'_id': {'$in': missing}})
+
     def containers(self):
         return self._cluster_provider.containers()
 
-    def clean_up_containers(self):
-        containers = self._cluster_provider.containers()
+    def clean_up_containers(self, in_flight=None):
+        # in_flight returns the ids of containers passing through a create pipeline since the listing began
+        sweep_started = time()
+
+        # the pool is only pruned if it is not filled during the listing, new pooled containers might not be listed
+        prune_pool = False
+        if self._config.defaults['data_container_description'].get('warm_pool_size'):
+            prune_pool = self._data_container_pool_lock.acquire(blocking=False)
+        try:
+            containers = self._cluster_provider.containers()
+            if prune_pool:
+                self._prune_data_container_pool(containers)
+        finally:
+            if prune_pool:
+                self._data_container_pool_lock.release()
+
         for key in list(containers):
             try:
                 ObjectId(key)
             except:
                 del containers[key]
 
+        full_sweep_interval_seconds = self._config.server_master.get('container_reconciliation', {}).get(
+            'full_sweep_interval_seconds', 60
+        )
+        transitions = []
+        if time() - self._last_full_sweep >= full_sweep_interval_seconds:
+            self._full_sweep(containers, transitions)
+            self._last_full_sweep = time()
+        else:
+            self._incremental_sweep(containers, transitions)
+
+        if in_flight:
+            container_ids = in_flight()
+            transitions = [
+                t for t in transitions if not (t[3] == VANISHED_DESCRIPTION and t[1] in container_ids)
+            ]
+        self._state_handler.transition_many(transitions)
+
+        seen_containers = {}
+        for name, container in containers.items():
+            seen_containers.setdefault(container.get('node'), {})[name] = container.get('exit_status')
+        self._seen_containers = seen_containers
+        self._last_sweep = sweep_started
+
+    def _full_sweep(self, containers, transitions):
         for collection in ['application_containers', 'data_containers']:
             cursor = self._mongo.db[collection].find({
                 '_id': {'$in': [ObjectId(key) for key in containers]}
-            }, {'state': 1})
+            }, {'state': 1, 'cluster_node': 1})
             for c in cursor:
-                name = str(c['_id'])
-                container = containers[name]
-                node_name = self._lookup_node_name(c['_id'], collection)
-                if c['state'] in end_states():
-                    self._cluster_provider.remove_container(node_name, c['_id'])
-                elif container.get('exit_status') and container['exit_status'] != 0:
-                    logs = 'container logs not available'
-                    try:
-                        logs = self._cluster_provider.logs_from_container(node_name, c['_id'])
-                    except:
-                        pass
-                    description = 'Container exited unexpectedly ({}): {}'.format(container['description'], logs)
-                    self._state_handler.transition(collection, c['_id'], 'failed', description)
-                    self._cluster_provider.remove_container(node_name, c['_id'])
+                self._reconcile_container(collection, c, containers[str(c['_id'])], transitions)
 
         for collection in ['application_containers', 'data_containers']:
             cursor = self._mongo.db[collection].find({
@@ -123,8 +272,83 @@ class Cluster:
             for c in cursor:
                 name = str(c['_id'])
                 if name not in containers:
-                    description = 'Container vanished.'
-                    self._state_handler.transition(collection, c['_id'], 'failed', description)
+                    description = VANISHED_DESCRIPTION
+                    transitions.append((collection, c['_id'], 'failed', description))
+
+    def _incremental_sweep(self, containers, transitions):
+        # only containers that appeared, exited or disappeared since the last round are looked up by _id. Containers
+        # which are still running are only checked against the containers that reached an end state recently, e.g. by
+        # a cancellation in the web service
+        changed = []
+        unchanged = set()
+        for name, container in containers.items():
+            seen = self._seen_containers.get(container.get('node'), {})
+            if name in seen and seen[name] == container.get('exit_status'):
+                unchanged.add(name)
+            else:
+                changed.append(ObjectId(name))
+
+        disappeared = []
+        for seen in self._seen_containers.values():
+            for name in seen:
+                if name not in containers:
+                    disappeared.append(ObjectId(name))
+
+        # transitions are written shortly after their timestamp, finished containers are therefore looked up since
+        # the previous round with some lookback
+        finished_since = self._last_sweep - FINISHED_LOOKBACK_SECONDS
+
+        for collection in ['application_containers', 'data_containers']:
+            if changed:
+                cursor = self._mongo.db[collection].find({
+                    '_id': {'$in': changed}
+                }, {'state': 1, 'cluster_node': 1})
+                for c in cursor:
+                    self._reconcile_container(collection, c, containers[str(c['_id'])], transitions)
+
+            if unchanged:
+                cursor = self._mongo.db[collection].find({
+                    'finished_at': {'$gte': finished_since}
+                }, {'state': 1, 'cluster_node': 1})
+                for c in cursor:
+                    name = str(c['_id'])
+                    if name in unchanged:
+                        self._reconcile_container(collection, c, containers[name], transitions)
+
+            if disappeared:
+                cursor = self._mongo.db[collection].find({
+                    '_id': {'$in': disappeared},
+                    'state': {'$in': [1, 2]}
+                }, {'_id': 1})
+                for c in cursor:
+                    description = VANISHED_DESCRIPTION
+                    transitions.append((collection, c['_id'], 'failed', description))
+
+    def _reconcile_container(self, collection, c, container, transitions):
+        node_name = c.get('cluster_node')
+        if c['state'] in end_states():
+            self._cluster_provider.remove_container(node_name, c['_id'])
+        elif container.get('exit_status') and container['exit_status'] != 0:
+            logs = 'container logs not available'
+            try:
+                logs = self._cluster_provider.logs_from_container(node_name, c['_id'])
+            except:
+                pass
+            description = 'Container exited unexpectedly ({}): {}'.format(container['description'], logs)
+            transitions.append((collection, c['_id'], 'failed', description))
+            self._cluster_provider.remove_container(node_name, c['_id'])
+
+    def update_garbage_collection_stats(self):
+        nodes = self._mongo.db['nodes'].find({'is_online': True}, {'cluster_node': 1})
+        for node in nodes:
+            try:
+                stats = self._cluster_provider.garbage_collection_stats(node['cluster_node'])
+            except:
+                continue
+            self._mongo.db['nodes'].update_one(
+                {'_id': node['_id']},
+                {'$set': {'garbage_collection': stats}}
+            )
 
     def clean_up_unused_data_containers(self):
         with self._data_container_lock:
@@ -156,17 +380,43 @@ class Cluster:
         return container['cluster_node']
 
     def _create_nodes_on_startup(self):
-        self._mongo.db['nodes'].drop()
         node_configs = self._read_node_configs()
-        threads = []
+
+        # the previous state of known nodes is kept, but no containers are placed before a node is ready again
+        self._mongo.db['nodes'].delete_many({'cluster_node': {'$nin': list(node_configs)}})
+        self._mongo.db['nodes'].update_many({}, {'$set': {'is_online': False, 'status': 'starting'}})
+
+        is_any_node_ready = Event()
+        ready_nodes = set()
+        network_lock = Lock()
+
         for node_name, node_config in node_configs.items():
             self._tee('Create node {}.'.format(node_name))
-            t = Thread(target=self._update_node, args=(node_name, node_config, True))
-            t.start()
-            threads.append(t)
-        for t in threads:
-            t.join()
-        self._cluster_provider.create_network()
+            Thread(target=self._create_node_on_startup, args=(
+                node_name, node_config, is_any_node_ready, ready_nodes, network_lock
+            )).start()
+
+        timeout = self._config.docker.get('node_startup_timeout_seconds', 30)
+        is_any_node_ready.wait(timeout)
+
+        with network_lock:
+            pending_nodes = [node_name for node_name in node_configs if node_name not in ready_nodes]
+        for node_name in pending_nodes:
+            self._tee('Node {} not ready after {} seconds, continuing in background.'.format(node_name, timeout))
+
+    def _create_node_on_startup(self, node_name, node_config, is_any_node_ready, ready_nodes, network_lock):
+        is_online = self._update_node(node_name, node_config, True)
+        if not is_online:
+            return
+
+        with network_lock:
+            if not ready_nodes:
+                try:
+                    self._cluster_provider.create_network()
+                except:
+                    self._tee('Could not create network via node {}: {}'.format(node_name, format_exc()))
+            ready_nodes.add(node_name)
+        is_any_node_ready.set()
 
     def update_node(self, node_name):
         node_configs = self._read_node_configs()
@@ -178,6 +428,7 @@ class Cluster:
             'cluster_node': node_name,
             'config': node_config,
             'is_online': True,
+            'status': 'online',
             'debug_info': None,
             'total_ram': None,
             'total_cpus': None
@@ -190,54 +441,21 @@ class Cluster:
         except:
             node['debug_info'] = format_exc()
             node['is_online'] = False
+            node['status'] = 'offline'
 
         self._mongo.db['nodes'].update_one({'cluster_node': node_name}, {'$set': node}, upsert=True)
 
         self._tee(json.dumps(node, indent=4))
 
         if not node['is_online'] and self._config.defaults['error_handling'].get('node_offline_notification'):
-            connector_access = self._config.defaults['error_handling']['node_offline_notification']
-            connector_access['add_meta_data'] = True
+            server = {
+                'connector_access': self._config.defaults['error_handling']['node_offline_notification'],
+                'add_meta_data': True
+            }
             meta_data = {'name': node_name}
-            notify(self._tee, [connector_access], meta_data)
+            notify(self._mongo, [server], meta_data)
 
         return node['is_online']
 
     def _read_node_configs(self):
-        node_configs = {}
-        if self._config.docker.get('docker_machine_dir'):
-            machine_dir = os.path.expanduser(self._config.docker['docker_machine_dir'])
-            machines_dir = os.path.join(machine_dir, 'machines')
-            for d in os.listdir(machines_dir):
-                with open(os.path.join(machines_dir, d, 'config.json')) as f:
-                    machine_config = json.load(f)
-                node_name = machine_config['Driver']['MachineName']
-                if not machine_config['HostOptions']['EngineOptions'].get('ArbitraryFlags'):
-                    continue
-                port = None
-                try:
-                    for flag in machine_config['HostOptions']['EngineOptions']['ArbitraryFlags']:
-                        key, val = flag.split('=')
-                        if key == 'cluster-advertise':
-                            port = int(val.split(':')[-1])
-                            break
-                except:
-                    pass
-                if not port:
-                    continue
-                node_config = {
-                    'base_url': '{}:{}'.format(machine_config['Driver']['IPAddress'], port),
-                    'tls': {
-                        'verify': os.path.join(machine_dir, 'certs', 'ca.pem'),
-                        'client_cert': [
-                            os.path.join(machine_dir, 'certs', 'cert.pem'),
-                            os.path.join(machine_dir, 'certs', 'key.pem')
-                        ],
-                        'assert_hostname': False
-                    }
-                }
-                node_configs[node_name] = node_config
-        if self._config.docker.get('nodes'):
-            for node_name, node_config in self._config.docker['nodes'].items():
-                node_configs[node_name] = node_config
-        return node_configs
+        return self._cluster_provider.node_configs()
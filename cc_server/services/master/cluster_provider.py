@@ -1,7 +1,12 @@
+import os
 import json
 import docker
-from queue import Queue
-from threading import Semaphore, Thread
+from queue import Queue, Empty
+from traceback import format_exc
+from threading import Semaphore, Thread, Lock, Event, Timer
+from time import time, sleep
+
+from cc_server.commons.task_templates import resolve_task_template
 
 
 class ClusterProviderException(Exception):
@@ -9,15 +14,22 @@ class ClusterProviderException(Exception):
 
 
 class DockerClientProxy:
-    def __init__(self, config, tee, node_name, node_config):
+    def __init__(self, config, tee, node_name, node_config, on_container_exit=None):
         self._config = config
         self._tee = tee
 
         self.node_name = node_name
         self.node_config = node_config
 
+        self._on_container_exit = on_container_exit
+
         self._thread_limit = Semaphore(self._config.docker['thread_limit'])
 
+        # image inventory of this node, image -> {'digests', 'size', 'pulled_at'}
+        self._images = {}
+        self._image_lock = Lock()
+        self._image_pulls = {}
+
         tls = False
         if self.node_config.get('tls'):
             tls = docker.tls.TLSConfig(**self.node_config['tls'])
@@ -35,6 +47,37 @@ class DockerClientProxy:
             version='auto'
         )
 
+        # container table of this node, fed by container lists, creations, removals and the docker events stream
+        self._container_table = {}
+        self._container_table_lock = Lock()
+        self._last_reconciliation = 0
+        self._events_connected = False
+        self._closed = False
+
+        # ip addresses of containers in the bridge network, resolved in bulk
+        self._ips = {}
+        self._ips_refreshed_at = 0
+        self._ip_lock = Lock()
+        self._ip_refresh_lock = Lock()
+
+        # background garbage collection of containers
+        garbage_collection = self._config.docker.get('garbage_collection', {})
+        self._removal_max_retries = garbage_collection.get('max_retries', 3)
+        self._removal_q = Queue()
+        self._removal_lock = Lock()
+        self._removals = set()
+        self._removal_stats = {'removed': 0, 'failed': 0, 'retried': 0}
+        for _ in range(garbage_collection.get('concurrency', 2)):
+            Thread(target=self._removal_loop, daemon=True).start()
+
+        events = self._config.docker.get('events', {})
+        self._reconcile_interval_seconds = events.get('reconcile_interval_seconds', 300)
+        if events.get('enabled'):
+            Thread(target=self._events_loop, daemon=True).start()
+
+    def close(self):
+        self._closed = True
+
     def info(self):
         with self._thread_limit:
             info = self.client.info()
@@ -45,6 +88,12 @@ class DockerClientProxy:
             'total_cpus': info['NCPU']
         }
 
+    def ping(self):
+        start = time()
+        with self._thread_limit:
+            self.client.ping()
+        return (time() - start) * 1000
+
     def inspect(self):
         self._tee('Inspect node {}.'.format(self.node_name))
 
@@ -55,12 +104,12 @@ class DockerClientProxy:
 
         container_name = 'inspect-{}'.format(self.node_name)
 
-        self.remove_container(container_name)
+        self.remove_container_now(container_name)
         self._create_inspection_container(container_name)
         self.start_container(container_name)
         self.wait_for_container(container_name)
 
-        for key, val in self.containers().items():
+        for key, val in self._list_containers().items():
             if key == container_name:
                 if val['exit_status'] != 0:
                     s = 'Inspection container on node {} exited with code {}: {}'.format(
@@ -69,9 +118,79 @@ class DockerClientProxy:
                     raise ClusterProviderException(s)
                 break
 
-        self.remove_container(container_name)
+        self.remove_container_now(container_name)
 
     def containers(self):
+        with self._container_table_lock:
+            is_recent = time() - self._last_reconciliation < self._reconcile_interval_seconds
+            if self._events_connected and is_recent:
+                return {name: dict(val) for name, val in self._container_table.items()}
+
+        containers = self._list_containers()
+        with self._container_table_lock:
+            self._container_table = {name: dict(val) for name, val in containers.items()}
+            self._last_reconciliation = time()
+        return containers
+
+    def _events_loop(self):
+        since = int(time())
+        while not self._closed:
+            try:
+                events = self.client.events(
+                    since=since,
+                    filters={'type': 'container', 'event': ['create', 'die', 'oom', 'destroy']},
+                    decode=True
+                )
+                with self._container_table_lock:
+                    self._events_connected = True
+                for event in events:
+                    if self._closed:
+                        break
+                    since = event.get('time', since)
+                    self._handle_event(event)
+            except:
+                # the stream is reopened with since, events of the gap are replayed by docker
+                pass
+            with self._container_table_lock:
+                self._events_connected = False
+            if not self._closed:
+                sleep(1)
+
+    def _handle_event(self, event):
+        action = event.get('Action', event.get('status'))
+        attributes = event.get('Actor', {}).get('Attributes', {})
+        name = attributes.get('name')
+        if not name:
+            return
+
+        with self._container_table_lock:
+            if action == 'destroy':
+                self._container_table.pop(name, None)
+                return
+
+            container = self._container_table.setdefault(name, {
+                'exit_status': None,
+                'description': None,
+                'node': self.node_name
+            })
+
+            if action == 'create':
+                container['exit_status'] = None
+                container['description'] = None
+            elif action == 'oom':
+                container['oom_killed'] = True
+            elif action == 'die':
+                exit_status = int(attributes.get('exitCode', -1))
+                description = 'Exited ({})'.format(exit_status)
+                if container.pop('oom_killed', False):
+                    description = '{} after running out of memory'.format(description)
+                container['exit_status'] = exit_status
+                container['description'] = description
+
+        if action == 'die' and self._on_container_exit:
+            self._on_container_exit(self.node_name, name)
+
+    def _list_containers(self):
         with self._thread_limit:
             containers = self.client.containers(quiet=False, all=True, limit=-1)
         result = {}
@@ -90,16 +209,58 @@ class DockerClientProxy:
         return result
 
     def remove_container(self, container_name):
+        # the container is removed in the background, see _removal_loop
+        container_name = str(container_name)
+        with self._removal_lock:
+            if container_name in self._removals:
+                return
+            self._removals.add(container_name)
+        self._removal_q.put((container_name, 0))
+
+    def remove_container_now(self, container_name):
+        container_name = str(container_name)
         try:
             with self._thread_limit:
-                self.client.kill(str(container_name))
-        except:
-            pass
-        try:
-            with self._thread_limit:
-                self.client.remove_container(str(container_name))
-        except:
+                self.client.remove_container(container_name, force=True)
+        except docker.errors.NotFound:
             pass
+        with self._container_table_lock:
+            self._container_table.pop(container_name, None)
+        with self._ip_lock:
+            self._ips.pop(container_name, None)
+
+    def garbage_collection_stats(self):
+        with self._removal_lock:
+            stats = dict(self._removal_stats)
+            stats['backlog'] = len(self._removals)
+        return stats
+
+    def _removal_loop(self):
+        while not self._closed or not self._removal_q.empty():
+            try:
+                container_name, trials = self._removal_q.get(timeout=1)
+            except Empty:
+                continue
+
+            try:
+                self.remove_container_now(container_name)
+            except:
+                if trials < self._removal_max_retries:
+                    with self._removal_lock:
+                        self._removal_stats['retried'] += 1
+                    Timer(2 ** trials, self._removal_q.put, args=((container_name, trials + 1),)).start()
+                    continue
+                self._tee('Could not remove container {} on node {}: {}'.format(
+                    container_name, self.node_name, format_exc()
+                ))
+                with self._removal_lock:
+                    self._removal_stats['failed'] += 1
+                    self._removals.discard(container_name)
+                continue
+
+            with self._removal_lock:
+                self._removal_stats['removed'] += 1
+                self._removals.discard(container_name)
 
     def wait_for_container(self, container_name):
         with self._thread_limit:
@@ -127,12 +288,28 @@ class DockerClientProxy:
 
     def create_container(self, *args, **kwargs):
         container_name = kwargs['name']
-        containers = self.containers()
-        if container_name in containers:
-            self.remove_container(container_name)
+        with self._container_table_lock:
+            is_known = container_name in self._container_table
+        if is_known:
+            self.remove_container_now(container_name)
 
-        with self._thread_limit:
-            self.client.create_container(*args, **kwargs)
+        try:
+            with self._thread_limit:
+                self.client.create_container(*args, **kwargs)
+        except docker.errors.APIError as e:
+            if e.status_code != 409:
+                raise
+            # name conflict with a container, which is not in the container table yet
+            self.remove_container_now(container_name)
+            with self._thread_limit:
+                self.client.create_container(*args, **kwargs)
+
+        with self._container_table_lock:
+            self._container_table[container_name] = {
+                'exit_status': None,
+                'description': None,
+                'node': self.node_name
+            }
 
     def connect_container_to_network(self, *args, **kwargs):
         with self._thread_limit:
@@ -141,11 +318,118 @@ class DockerClientProxy:
     def get_ip(self, _id):
         if self._config.docker.get('net'):
             return str(_id)
+
+        container_name = str(_id)
+        with self._ip_lock:
+            ip = self._ips.get(container_name)
+            if ip:
+                return ip
+            started = time()
+
+        # one inspection of the bridge network resolves the addresses of all containers started in the meantime
+        with self._ip_refresh_lock:
+            with self._ip_lock:
+                is_refreshed = self._ips_refreshed_at >= started
+                ip = self._ips.get(container_name)
+            if ip:
+                return ip
+            if not is_refreshed:
+                self._refresh_ips()
+                with self._ip_lock:
+                    ip = self._ips.get(container_name)
+                if ip:
+                    return ip
+
         with self._thread_limit:
-            container = self.client.inspect_container(str(_id))
+            container = self.client.inspect_container(container_name)
         return container['NetworkSettings']['Networks']['bridge']['IPAddress']
 
+    def _refresh_ips(self):
+        refreshed_at = time()
+        with self._thread_limit:
+            network = self.client.inspect_network('bridge')
+        ips = {}
+        for container in (network.get('Containers') or {}).values():
+            if container.get('IPv4Address'):
+                ips[container['Name']] = container['IPv4Address'].split('/')[0]
+        with self._ip_lock:
+            self._ips = ips
+            self._ips_refreshed_at = refreshed_at
+
     def update_image(self, image, registry_auth):
+        # concurrent requests for the same image on this node are coalesced into one pull
+        with self._image_lock:
+            pull = self._image_pulls.get(image)
+            is_owner = pull is None
+            if is_owner:
+                pull = {'done': Event(), 'exception': None}
+                self._image_pulls[image] = pull
+
+        if not is_owner:
+            pull['done'].wait()
+            if pull['exception']:
+                raise pull['exception']
+            return
+
+        try:
+            if not self._is_image_current(image, registry_auth):
+                self._pull_image(image, registry_auth)
+        except Exception as e:
+            pull['exception'] = e
+            raise
+        finally:
+            with self._image_lock:
+                del self._image_pulls[image]
+            pull['done'].set()
+
+    def images(self):
+        with self._image_lock:
+            return {image: dict(val) for image, val in self._images.items()}
+
+    def _is_image_current(self, image, registry_auth):
+        local_image = self._inspect_local_image(image)
+        if not local_image:
+            return False
+
+        image_refresh = self._config.docker.get('image_refresh', {})
+        policy = image_refresh.get('policy', 'always')
+
+        if policy == 'if-missing':
+            return True
+
+        if policy == 'interval':
+            return time() - local_image['pulled_at'] < image_refresh.get('interval_seconds', 0)
+
+        remote_digest = self._remote_digest(image, registry_auth)
+        return remote_digest is not None and remote_digest in local_image['digests']
+
+    def _inspect_local_image(self, image):
+        try:
+            with self._thread_limit:
+                info = self.client.inspect_image(image)
+        except docker.errors.NotFound:
+            with self._image_lock:
+                self._images.pop(image, None)
+            return None
+
+        with self._image_lock:
+            local_image = self._images.setdefault(image, {'pulled_at': 0})
+            local_image['digests'] = [d.split('@')[-1] for d in info.get('RepoDigests') or []]
+            local_image['size'] = info.get('Size', 0) // (1024 * 1024)
+            return dict(local_image)
+
+    def _remote_digest(self, image, registry_auth):
+        try:
+            with self._thread_limit:
+                distribution = self.client.inspect_distribution(image, auth_config=registry_auth)
+        except AttributeError:
+            # old docker-py versions cannot ask the registry for a digest without pulling
+            return None
+        except docker.errors.APIError:
+            return None
+        return distribution['Descriptor']['digest']
+
+    def _pull_image(self, image, registry_auth):
         with self._thread_limit:
             self._tee('Pull image {} on node {}.'.format(image, self.node_name))
             for line in self.client.pull(image, stream=True, auth_config=registry_auth):
@@ -153,6 +437,10 @@ class DockerClientProxy:
                 if 'error' in line.lower():
                     raise ClusterProviderException(line)
 
+        with self._image_lock:
+            self._images.setdefault(image, {})['pulled_at'] = time()
+        self._inspect_local_image(image)
+
     def _create_inspection_container(self, container_name):
         settings = {
             'inspection_url': '{}'.format(self._config.server_web['external_url'].rstrip('/'))
@@ -185,6 +473,53 @@ class DockerProvider:
         self._config = config
 
         self._clients = {}
+        self._container_exit_handler = None
+
+    def set_container_exit_handler(self, handler):
+        self._container_exit_handler = handler
+
+    def _container_exited(self, node_name, container_name):
+        if self._container_exit_handler:
+            self._container_exit_handler()
+
+    def node_configs(self):
+        node_configs = {}
+        if self._config.docker.get('docker_machine_dir'):
+            machine_dir = os.path.expanduser(self._config.docker['docker_machine_dir'])
+            machines_dir = os.path.join(machine_dir, 'machines')
+            for d in os.listdir(machines_dir):
+                with open(os.path.join(machines_dir, d, 'config.json')) as f:
+                    machine_config = json.load(f)
+                node_name = machine_config['Driver']['MachineName']
+                if not machine_config['HostOptions']['EngineOptions'].get('ArbitraryFlags'):
+                    continue
+                port = None
+                try:
+                    for flag in machine_config['HostOptions']['EngineOptions']['ArbitraryFlags']:
+                        key, val = flag.split('=')
+                        if key == 'cluster-advertise':
+                            port = int(val.split(':')[-1])
+                            break
+                except:
+                    pass
+                if not port:
+                    continue
+                node_config = {
+                    'base_url': '{}:{}'.format(machine_config['Driver']['IPAddress'], port),
+                    'tls': {
+                        'verify': os.path.join(machine_dir, 'certs', 'ca.pem'),
+                        'client_cert': [
+                            os.path.join(machine_dir, 'certs', 'cert.pem'),
+                            os.path.join(machine_dir, 'certs', 'key.pem')
+                        ],
+                        'assert_hostname': False
+                    }
+                }
+                node_configs[node_name] = node_config
+        if self._config.docker.get('nodes'):
+            for node_name, node_config in self._config.docker['nodes'].items():
+                node_configs[node_name] = node_config
+        return node_configs
 
     def logs_from_container(self, node_name, container_id):
         return self._clients[node_name].logs_from_container(container_id)
@@ -192,25 +527,29 @@ class DockerProvider:
     def node_info(self, node_name):
         return self._clients[node_name].info()
 
+    def ping(self, node_name):
+        return self._clients[node_name].ping()
+
     def update_node(self, node_name, node_config, startup):
         if not node_config:
             if node_name in self._clients:
-                del self._clients[node_name]
+                self._clients.pop(node_name).close()
             raise Exception('Could not find config for node {}.'.format(node_name))
 
         try:
             node = self._clients[node_name]
             if not startup:
                 node.inspect()
-            info = node.info(node_name)
+            info = node.info()
         except:
             if node_name in self._clients:
-                del self._clients[node_name]
+                self._clients.pop(node_name).close()
             node = DockerClientProxy(
                 config=self._config,
                 tee=self._tee,
                 node_name=node_name,
-                node_config=node_config
+                node_config=node_config,
+                on_container_exit=self._container_exited
             )
             if not startup:
                 node.inspect()
@@ -238,8 +577,8 @@ class DockerProvider:
     def create_container(self, container_id, collection):
         if collection == 'application_containers':
             self._create_application_container(container_id)
-        elif collection == 'data_containers':
-            self._create_data_container(container_id)
+        elif collection in ['data_containers', 'data_container_pool']:
+            self._create_data_container(container_id, collection)
         else:
             raise ClusterProviderException('Collection {} not valid.', collection)
 
@@ -249,13 +588,26 @@ class DockerProvider:
         except:
             pass
 
+    def garbage_collection_stats(self, node_name):
+        return self._clients[node_name].garbage_collection_stats()
+
     def update_image(self, node_name, image, registry_auth):
         self._clients[node_name].update_image(image, registry_auth)
 
+    def images(self, node_name):
+        return self._clients[node_name].images()
+
     def _create_application_container(self, application_container_id):
-        application_container = self._mongo.db['application_containers'].find_one({'_id': application_container_id})
+        application_container = self._mongo.db['application_containers'].find_one(
+            {'_id': application_container_id},
+            {'task_id': 1, 'callback_key': 1, 'cluster_node': 1}
+        )
         task_id = application_container['task_id'][0]
-        task = self._mongo.db['tasks'].find_one({'_id': task_id})
+        task = self._mongo.db['tasks'].find_one(
+            {'_id': task_id},
+            {'application_container_description': 1, 'task_template_id': 1}
+        )
+        resolve_task_template(self._mongo, task)
 
         settings = {
             'container_id': str(application_container_id),
@@ -300,8 +652,11 @@ class DockerProvider:
                 net_id=self._config.docker['net']
             )
 
-    def _create_data_container(self, data_container_id):
-        data_container = self._mongo.db['data_containers'].find_one({'_id': data_container_id})
+    def _create_data_container(self, data_container_id, collection):
+        data_container = self._mongo.db[collection].find_one(
+            {'_id': data_container_id},
+            {'callback_key': 1, 'cluster_node': 1}
+        )
 
         settings = {
             'container_id': str(data_container_id),
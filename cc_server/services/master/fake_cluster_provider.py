@@ -0,0 +1,221 @@
+import random
+import requests
+from threading import Thread, Lock
+from time import time, sleep
+from traceback import format_exc
+
+from cc_server.commons.states import state_to_index
+from cc_server.services.master.cluster_provider import ClusterProviderException
+
+
+# simulates a docker cluster in-process, containers send callbacks to cc-server-web like real containers
+class FakeProvider:
+    def __init__(self, config, tee, mongo):
+        self._tee = tee
+        self._mongo = mongo
+        self._config = config
+
+        fake_cluster = self._config.fake_cluster or {}
+        self._num_nodes = fake_cluster.get('num_nodes', 1)
+        self._node_ram = fake_cluster.get('node_ram', 16384)
+        self._node_cpus = fake_cluster.get('node_cpus', 8)
+        self._pull_seconds = fake_cluster.get('pull_seconds', 0)
+        self._start_seconds = fake_cluster.get('start_seconds', 0)
+        self._run_seconds = fake_cluster.get('run_seconds', 0)
+        self._failure_rate = fake_cluster.get('failure_rate', 0)
+        self._exit_failure_rate = fake_cluster.get('exit_failure_rate', 0)
+
+        self._external_url = self._config.server_web['external_url'].rstrip('/')
+
+        self._lock = Lock()
+        self._nodes = {}
+        self._container_exit_handler = None
+
+    def set_container_exit_handler(self, handler):
+        self._container_exit_handler = handler
+
+    def node_configs(self):
+        return {'fake-node-{}'.format(i): {'fake': True} for i in range(self._num_nodes)}
+
+    def update_node(self, node_name, node_config, startup):
+        if not node_config:
+            raise Exception('Could not find config for node {}.'.format(node_name))
+
+        with self._lock:
+            self._nodes.setdefault(node_name, {'images': {}, 'containers': {}})
+
+        return {
+            'cluster_node': node_name,
+            'total_ram': self._node_ram,
+            'total_cpus': self._node_cpus
+        }
+
+    def node_info(self, node_name):
+        return self.update_node(node_name, {'fake': True}, False)
+
+    def ping(self, node_name):
+        self._node(node_name)
+        return 0.0
+
+    def create_network(self):
+        pass
+
+    def update_image(self, node_name, image, registry_auth):
+        node = self._node(node_name)
+        with self._lock:
+            is_present = image in node['images']
+        if is_present:
+            return
+        sleep(self._pull_seconds)
+        with self._lock:
+            node['images'][image] = {'digests': [], 'size': 0, 'pulled_at': time()}
+
+    def images(self, node_name):
+        node = self._node(node_name)
+        with self._lock:
+            return {image: dict(val) for image, val in node['images'].items()}
+
+    def garbage_collection_stats(self, node_name):
+        self._node(node_name)
+        return {'removed': 0, 'failed': 0, 'retried': 0, 'backlog': 0}
+
+    def create_container(self, container_id, collection):
+        if collection == 'application_containers':
+            callback_url = '{}/application-containers/callback'.format(self._external_url)
+        elif collection in ['data_containers', 'data_container_pool']:
+            callback_url = '{}/data-containers/callback'.format(self._external_url)
+        else:
+            raise ClusterProviderException('Collection {} not valid.'.format(collection))
+
+        c = self._mongo.db[collection].find_one(
+            {'_id': container_id},
+            {'cluster_node': 1, 'callback_key': 1}
+        )
+        node = self._node(c['cluster_node'])
+
+        if random.random() < self._failure_rate:
+            raise ClusterProviderException('Simulated creation failure of container {}.'.format(container_id))
+
+        with self._lock:
+            node['containers'][str(container_id)] = {
+                'exit_status': None,
+                'description': None,
+                'node': c['cluster_node'],
+                'is_application_container': collection == 'application_containers',
+                'callback_url': callback_url,
+                'callback_key': c['callback_key'],
+                'is_removed': False,
+                'logs': []
+            }
+
+    def start_container(self, node_name, container_id):
+        container = self._container(node_name, container_id)
+
+        if random.random() < self._failure_rate:
+            raise ClusterProviderException('Simulated start failure of container {}.'.format(container_id))
+
+        Thread(target=self._run_container, args=(str(container_id), container)).start()
+
+    def wait_for_container(self, node_name, container_id):
+        container = self._container(node_name, container_id)
+        while container['exit_status'] is None and not container['is_removed']:
+            sleep(0.1)
+
+    def remove_container(self, node_name, container_id):
+        try:
+            node = self._node(node_name)
+        except ClusterProviderException:
+            return
+        with self._lock:
+            container = node['containers'].pop(str(container_id), None)
+            if container:
+                container['is_removed'] = True
+
+    def logs_from_container(self, node_name, container_id):
+        container = self._container(node_name, container_id)
+        return '\n'.join(container['logs'])
+
+    def get_ip(self, node_name, container_id):
+        self._container(node_name, container_id)
+        return '127.0.0.1'
+
+    def containers(self):
+        result = {}
+        with self._lock:
+            for node in self._nodes.values():
+                for name, container in node['containers'].items():
+                    result[name] = {
+                        'exit_status': container['exit_status'],
+                        'description': container['description'],
+                        'node': container['node']
+                    }
+        return result
+
+    def _node(self, node_name):
+        with self._lock:
+            node = self._nodes.get(node_name)
+        if not node:
+            raise ClusterProviderException('Node {} not available.'.format(node_name))
+        return node
+
+    def _container(self, node_name, container_id):
+        node = self._node(node_name)
+        with self._lock:
+            container = node['containers'].get(str(container_id))
+        if not container:
+            raise ClusterProviderException('Container {} not found on node {}.'.format(container_id, node_name))
+        return container
+
+    def _run_container(self, container_id, container):
+        sleep(self._start_seconds)
+
+        try:
+            if container['is_application_container']:
+                exit_status = self._run_application_container(container_id, container)
+            else:
+                exit_status = self._run_data_container(container_id, container)
+        except:
+            container['logs'].append(format_exc())
+            exit_status = 1
+
+        if exit_status is None or container['is_removed']:
+            return
+
+        container['exit_status'] = exit_status
+        container['description'] = 'Exited ({})'.format(exit_status)
+        if self._container_exit_handler:
+            self._container_exit_handler()
+
+    def _run_application_container(self, container_id, container):
+        self._callback(container_id, container, 0, 'Container started.')
+        self._callback(container_id, container, 1, 'Input files available.')
+        sleep(self._run_seconds)
+        if container['is_removed']:
+            return None
+        if random.random() < self._exit_failure_rate:
+            container['logs'].append('Simulated application failure.')
+            return 1
+        self._callback(container_id, container, 2, 'Application terminated.')
+        self._callback(container_id, container, 3, 'Result files sent.')
+        return 0
+
+    def _run_data_container(self, container_id, container):
+        self._callback(container_id, container, 0, 'Container started.')
+        self._callback(container_id, container, 1, 'Input files available.')
+        # data containers keep running until they are removed
+        return None
+
+    def _callback(self, container_id, container, callback_type, description):
+        if container['is_removed']:
+            return
+        r = requests.post(container['callback_url'], json={
+            'callback_key': container['callback_key'],
+            'callback_type': callback_type,
+            'container_id': container_id,
+            'content': {
+                'state': state_to_index('success'),
+                'description': description
+            }
+        })
+        container['logs'].append('Callback {}: {}'.format(callback_type, r.status_code))
+        r.raise_for_status()
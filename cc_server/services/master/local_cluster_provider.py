@@ -0,0 +1,245 @@
+import os
+import json
+import shlex
+import sys
+import shutil
+import signal
+import subprocess
+from threading import Thread, Lock
+from time import time
+
+from cc_server.commons.task_templates import resolve_task_template
+from cc_server.services.master.cluster_provider import ClusterProviderException
+
+NODE_NAME = 'local'
+
+# only depends on the standard library, such that it runs without the cc_server package on the python path
+LAUNCHER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'local_launcher.py')
+
+
+# runs application and data containers as supervised local processes instead of docker containers
+class LocalProcessProvider:
+    def __init__(self, config, tee, mongo):
+        self._tee = tee
+        self._mongo = mongo
+        self._config = config
+
+        local_cluster = self._config.local_cluster or {}
+        self._total_ram = local_cluster.get(
+            'total_ram', os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // (1024 * 1024)
+        )
+        self._total_cpus = local_cluster.get('total_cpus', os.cpu_count())
+        self._work_dir = os.path.expanduser(local_cluster.get('work_dir', '~/.cc_server/local_cluster'))
+        self._cgroup_dir = local_cluster.get('cgroup_dir')
+
+        self._lock = Lock()
+        self._containers = {}
+        self._container_exit_handler = None
+
+    def set_container_exit_handler(self, handler):
+        self._container_exit_handler = handler
+
+    def node_configs(self):
+        return {NODE_NAME: {'work_dir': self._work_dir}}
+
+    def update_node(self, node_name, node_config, startup):
+        if node_name != NODE_NAME:
+            raise Exception('Could not find config for node {}.'.format(node_name))
+
+        if not os.path.exists(self._work_dir):
+            os.makedirs(self._work_dir)
+
+        return {
+            'cluster_node': NODE_NAME,
+            'total_ram': self._total_ram,
+            'total_cpus': self._total_cpus
+        }
+
+    def node_info(self, node_name):
+        return self.update_node(node_name, None, False)
+
+    def ping(self, node_name):
+        if node_name != NODE_NAME:
+            raise ClusterProviderException('Node {} not available.'.format(node_name))
+        return 0.0
+
+    def create_network(self):
+        pass
+
+    def update_image(self, node_name, image, registry_auth):
+        # entry points are executed in the local environment, there are no images to pull
+        pass
+
+    def images(self, node_name):
+        return {}
+
+    def garbage_collection_stats(self, node_name):
+        return {'removed': 0, 'failed': 0, 'retried': 0, 'backlog': 0}
+
+    def create_container(self, container_id, collection):
+        if collection == 'application_containers':
+            command, container_ram = self._application_container_command(container_id)
+        elif collection in ['data_containers', 'data_container_pool']:
+            command, container_ram = self._data_container_command(container_id, collection)
+        else:
+            raise ClusterProviderException('Collection {} not valid.'.format(collection))
+
+        container_dir = os.path.join(self._work_dir, str(container_id))
+        if os.path.exists(container_dir):
+            shutil.rmtree(container_dir)
+        os.makedirs(container_dir)
+
+        with self._lock:
+            self._containers[str(container_id)] = {
+                'exit_status': None,
+                'description': None,
+                'node': NODE_NAME,
+                'command': command,
+                'container_ram': container_ram,
+                'container_dir': container_dir,
+                'process': None
+            }
+
+    def start_container(self, node_name, container_id):
+        container = self._container(container_id)
+        mem_limit = int(container['container_ram'] * 1024 * 1024)
+
+        cgroup = ''
+        if self._cgroup_dir:
+            cgroup = self._create_cgroup(str(container_id), mem_limit)
+
+        # the launcher applies the limits before the command is executed, preexec_fn is not safe in the threaded master
+        launcher = [sys.executable, LAUNCHER, str(mem_limit), cgroup]
+
+        log_file = open(os.path.join(container['container_dir'], 'container.log'), 'w')
+        process = subprocess.Popen(
+            launcher + shlex.split(container['command']),
+            cwd=container['container_dir'],
+            stdout=log_file,
+            stderr=subprocess.STDOUT,
+            start_new_session=True
+        )
+        log_file.close()
+        container['process'] = process
+
+        Thread(target=self._supervise, args=(str(container_id), container)).start()
+
+    def wait_for_container(self, node_name, container_id):
+        container = self._container(container_id)
+        if container['process']:
+            container['process'].wait()
+
+    def remove_container(self, node_name, container_id):
+        with self._lock:
+            container = self._containers.pop(str(container_id), None)
+        if not container:
+            return
+
+        process = container['process']
+        if process and process.poll() is None:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+            process.wait()
+
+        shutil.rmtree(container['container_dir'], ignore_errors=True)
+        if self._cgroup_dir:
+            try:
+                os.rmdir(os.path.join(self._cgroup_dir, str(container_id)))
+            except OSError:
+                pass
+
+    def logs_from_container(self, node_name, container_id):
+        container = self._container(container_id)
+        with open(os.path.join(container['container_dir'], 'container.log')) as f:
+            return f.read()
+
+    def get_ip(self, node_name, container_id):
+        return '127.0.0.1'
+
+    def containers(self):
+        with self._lock:
+            return {
+                name: {
+                    'exit_status': container['exit_status'],
+                    'description': container['description'],
+                    'node': container['node']
+                } for name, container in self._containers.items()
+            }
+
+    def _container(self, container_id):
+        with self._lock:
+            container = self._containers.get(str(container_id))
+        if not container:
+            raise ClusterProviderException('Container {} not found.'.format(container_id))
+        return container
+
+    def _supervise(self, container_id, container):
+        start = time()
+        exit_status = container['process'].wait()
+        container['exit_status'] = exit_status
+        container['description'] = 'Exited ({}) after {:.1f} seconds'.format(exit_status, time() - start)
+        if self._container_exit_handler:
+            self._container_exit_handler()
+
+    def _create_cgroup(self, container_id, mem_limit):
+        cgroup = os.path.join(self._cgroup_dir, container_id)
+        try:
+            if not os.path.exists(cgroup):
+                os.makedirs(cgroup)
+            with open(os.path.join(cgroup, 'memory.max'), 'w') as f:
+                f.write(str(mem_limit))
+        except OSError:
+            self._tee('Could not create cgroup {} for container {}, only rlimits apply.'.format(cgroup, container_id))
+            return ''
+        return cgroup
+
+    def _application_container_command(self, application_container_id):
+        application_container = self._mongo.db['application_containers'].find_one(
+            {'_id': application_container_id},
+            {'task_id': 1, 'callback_key': 1}
+        )
+        task = self._mongo.db['tasks'].find_one(
+            {'_id': application_container['task_id'][0]},
+            {'application_container_description': 1, 'task_template_id': 1}
+        )
+        resolve_task_template(self._mongo, task)
+
+        settings = {
+            'container_id': str(application_container_id),
+            'callback_key': application_container['callback_key'],
+            'callback_url': '{}/application-containers/callback'.format(self._config.server_web['external_url'].rstrip('/'))
+        }
+
+        entry_point = self._config.defaults['application_container_description']['entry_point']
+        if task['application_container_description'].get('entry_point'):
+            entry_point = task['application_container_description']['entry_point']
+
+        command = '{} \'{}\''.format(
+            entry_point,
+            json.dumps(settings)
+        )
+
+        return command, task['application_container_description']['container_ram']
+
+    def _data_container_command(self, data_container_id, collection):
+        data_container = self._mongo.db[collection].find_one(
+            {'_id': data_container_id},
+            {'callback_key': 1}
+        )
+
+        settings = {
+            'container_id': str(data_container_id),
+            'callback_key': data_container['callback_key'],
+            'callback_url': '{}/data-containers/callback'.format(self._config.server_web['external_url'].rstrip('/')),
+        }
+
+        entry_point = self._config.defaults['data_container_description']['entry_point']
+
+        command = '{} \'{}\''.format(
+            entry_point,
+            json.dumps(settings)
+        )
+
+        return command, self._config.defaults['data_container_description']['container_ram']
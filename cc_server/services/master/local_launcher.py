@@ -0,0 +1,26 @@
+import os
+import sys
+import resource
+
+
+# started by LocalProcessProvider in place of a container command: joins the cgroup and applies the memory limit of the
+# container in its own process, then replaces itself with the command, such that the command never runs without them
+# usage: python3 local_launcher.py MEM_LIMIT CGROUP_DIR COMMAND [ARGS...]
+def main():
+    mem_limit = int(sys.argv[1])
+    cgroup = sys.argv[2]
+    command = sys.argv[3:]
+
+    if cgroup:
+        try:
+            with open(os.path.join(cgroup, 'cgroup.procs'), 'w') as f:
+                f.write(str(os.getpid()))
+        except OSError:
+            print('Could not add process to cgroup {}, only rlimits apply.'.format(cgroup), file=sys.stderr, flush=True)
+
+    resource.setrlimit(resource.RLIMIT_AS, (mem_limit, mem_limit))
+    os.execvp(command[0], command)
+
+
+if __name__ == '__main__':
+    main()
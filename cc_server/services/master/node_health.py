@@ -0,0 +1,161 @@
+from threading import Thread, Lock
+from time import time, sleep
+from traceback import format_exc
+
+ONLINE = 'online'
+DEGRADED = 'degraded'
+OFFLINE = 'offline'
+
+# granularity of the per node schedules of pings and inspections
+HEALTH_LOOP_TICK_SECONDS = 1
+
+
+class NodeHealthMonitor:
+    def __init__(self, config, tee, mongo, cluster):
+        self._config = config
+        self._tee = tee
+        self._mongo = mongo
+        self._cluster = cluster
+
+        node_health = self._config.server_master.get('node_health', {})
+        self._interval_seconds = node_health.get('interval_seconds', 10)
+        self._failure_threshold = node_health.get('failure_threshold', 3)
+        self._latency_threshold_ms = node_health.get('latency_threshold_ms')
+        self._inspection_backoff_seconds = node_health.get('inspection_backoff_seconds', 30)
+        self._max_inspection_backoff_seconds = node_health.get('max_inspection_backoff_seconds', 960)
+
+        # circuit breaker per node
+        self._lock = Lock()
+        self._breakers = {}
+
+        Thread(target=self._health_loop).start()
+
+    def request_inspection(self, node_name):
+        with self._lock:
+            breaker = self._breaker(node_name)
+            breaker['backoff_seconds'] = self._inspection_backoff_seconds
+            breaker['next_inspection'] = 0
+            breaker['state'] = OFFLINE
+            breaker['is_inspection_requested'] = True
+
+        # the scheduler stops placing containers on the node right away, not only after the inspection
+        self._mongo.db['nodes'].update_one({'cluster_node': node_name}, {'$set': {'status': OFFLINE}})
+
+    def _breaker(self, node_name):
+        breaker = self._breakers.get(node_name)
+        if not breaker:
+            breaker = {
+                'state': ONLINE,
+                'failures': 0,
+                'backoff_seconds': self._inspection_backoff_seconds,
+                'next_ping': 0,
+                'next_inspection': 0,
+                'is_inspection_requested': False,
+                'is_busy': False
+            }
+            self._breakers[node_name] = breaker
+        return breaker
+
+    def _health_loop(self):
+        # every node is checked on its own schedule, a slow ping or inspection only delays the node concerned
+        while True:
+            try:
+                self._check_nodes()
+            except:
+                self._tee('Node health check failed: {}'.format(format_exc()))
+            sleep(min(self._interval_seconds, HEALTH_LOOP_TICK_SECONDS))
+
+    def _check_nodes(self):
+        nodes = self._mongo.db['nodes'].find({}, {'cluster_node': 1, 'is_online': 1})
+        for node in nodes:
+            node_name = node['cluster_node']
+            with self._lock:
+                breaker = self._breaker(node_name)
+                if breaker['is_busy']:
+                    continue
+                if not node['is_online'] and breaker['state'] != OFFLINE:
+                    # the node has been marked offline by a full inspection elsewhere
+                    breaker['state'] = OFFLINE
+                    breaker['next_inspection'] = time() + breaker['backoff_seconds']
+                elif node['is_online'] and breaker['state'] == OFFLINE and not breaker['is_inspection_requested']:
+                    # the node has come online elsewhere, e.g. after a slow startup
+                    breaker['state'] = ONLINE
+                    breaker['failures'] = 0
+                    breaker['backoff_seconds'] = self._inspection_backoff_seconds
+
+                if breaker['state'] == OFFLINE:
+                    if breaker['next_inspection'] > time():
+                        continue
+                    target = self._inspect
+                else:
+                    if breaker['next_ping'] > time():
+                        continue
+                    target = self._ping
+                breaker['is_busy'] = True
+
+            Thread(target=self._run, args=(target, node_name)).start()
+
+    def _run(self, target, node_name):
+        try:
+            target(node_name)
+        except:
+            self._tee('Node health check of {} failed: {}'.format(node_name, format_exc()))
+        finally:
+            with self._lock:
+                breaker = self._breaker(node_name)
+                breaker['is_busy'] = False
+                breaker['next_ping'] = time() + self._interval_seconds
+
+    def _ping(self, node_name):
+        latency_ms = None
+        try:
+            latency_ms = self._cluster.ping(node_name)
+            is_reachable = True
+        except:
+            is_reachable = False
+
+        with self._lock:
+            breaker = self._breaker(node_name)
+            if is_reachable:
+                breaker['failures'] = 0
+                state = ONLINE
+                if self._latency_threshold_ms is not None and latency_ms > self._latency_threshold_ms:
+                    state = DEGRADED
+            else:
+                breaker['failures'] += 1
+                state = DEGRADED
+                if breaker['failures'] >= self._failure_threshold:
+                    state = OFFLINE
+            is_opened = state == OFFLINE and breaker['state'] != OFFLINE
+            breaker['state'] = state
+
+        self._mongo.db['nodes'].update_one(
+            {'cluster_node': node_name},
+            {'$set': {'status': state, 'latency_ms': latency_ms}}
+        )
+
+        if is_opened:
+            # the inspection is started by the health loop, such that pings of other nodes are not held up
+            self._tee('Node {} did not respond {} times in a row.'.format(node_name, self._failure_threshold))
+            with self._lock:
+                self._breaker(node_name)['next_inspection'] = 0
+
+    def _inspect(self, node_name):
+        is_online = self._cluster.update_node(node_name)
+
+        with self._lock:
+            breaker = self._breaker(node_name)
+            breaker['is_inspection_requested'] = False
+            if is_online:
+                breaker['state'] = ONLINE
+                breaker['failures'] = 0
+                breaker['backoff_seconds'] = self._inspection_backoff_seconds
+            else:
+                breaker['state'] = OFFLINE
+                breaker['next_inspection'] = time() + breaker['backoff_seconds']
+                breaker['backoff_seconds'] = min(
+                    breaker['backoff_seconds'] * 2, self._max_inspection_backoff_seconds
+                )
+
+        if is_online:
+            self._tee('Node {} is online.'.format(node_name))
@@ -0,0 +1,159 @@
+import requests
+from pymongo import ASCENDING, ReturnDocument
+from requests.adapters import HTTPAdapter
+from threading import Thread, Lock, Event
+from time import time
+from traceback import format_exc
+
+from cc_server.commons.helper import remove_secrets
+from cc_server.commons.notification import NOTIFICATIONS_COLLECTION, send
+
+
+# sends the notifications of the outbox in the background, such that slow notification servers do not block
+# callbacks or scheduling
+class NotificationDelivery:
+    def __init__(self, config, tee, mongo):
+        self._config = config
+        self._tee = tee
+        self._mongo = mongo
+
+        notifications = self._config.server_master.get('notifications', {})
+        self._interval_seconds = notifications.get('interval_seconds', 1)
+        self._timeout_seconds = notifications.get('timeout_seconds', 10)
+        self._max_retries = notifications.get('max_retries', 5)
+        self._retry_backoff_seconds = notifications.get('retry_backoff_seconds', 2)
+        self._max_concurrent_deliveries = notifications.get('max_concurrent_deliveries', 16)
+        self._max_concurrent_deliveries_per_endpoint = notifications.get('max_concurrent_deliveries_per_endpoint', 2)
+        self._batch_window_seconds = notifications.get('batch_window_seconds', 0)
+        self._max_batch_size = notifications.get('max_batch_size', 100)
+
+        self._lock = Lock()
+        self._in_flight = {}
+        self._sessions = {}
+        self._wake = Event()
+
+        collection = self._mongo.db[NOTIFICATIONS_COLLECTION]
+        collection.create_index([('state', ASCENDING), ('next_attempt_at', ASCENDING)])
+
+        # deliveries interrupted by a restart are sent again
+        collection.update_many({'state': 'delivering'}, {'$set': {'state': 'pending', 'claimed_by': None}})
+
+        Thread(target=self._delivery_loop).start()
+
+    def wake(self):
+        self._wake.set()
+
+    def _delivery_loop(self):
+        while True:
+            self._wake.wait(self._interval_seconds)
+            self._wake.clear()
+            try:
+                self._dispatch()
+            except:
+                self._tee('Notification delivery failed: {}'.format(format_exc()))
+
+    def _dispatch(self):
+        while True:
+            with self._lock:
+                if sum(self._in_flight.values()) >= self._max_concurrent_deliveries:
+                    return
+                saturated = [
+                    e for e, n in self._in_flight.items() if n >= self._max_concurrent_deliveries_per_endpoint
+                ]
+
+            # notifications of servers receiving batches wait for others to the same server during the batch window
+            now = time()
+            notification = self._mongo.db[NOTIFICATIONS_COLLECTION].find_one_and_update(
+                {
+                    'state': 'pending',
+                    '$or': [
+                        {'batch': {'$ne': True}, 'next_attempt_at': {'$lte': now}},
+                        {'batch': True, 'next_attempt_at': {'$lte': now - self._batch_window_seconds}}
+                    ],
+                    'endpoint': {'$nin': saturated}
+                },
+                {'$set': {'state': 'delivering'}},
+                sort=[('next_attempt_at', ASCENDING)],
+                return_document=ReturnDocument.AFTER
+            )
+            if not notification:
+                return
+
+            notifications = [notification]
+            if self._batch_window_seconds and notification.get('batch'):
+                notifications += self._claim_batch(notification)
+
+            with self._lock:
+                e = notification['endpoint']
+                self._in_flight[e] = self._in_flight.get(e, 0) + 1
+
+            Thread(target=self._deliver, args=(notifications,)).start()
+
+    def _claim_batch(self, notification):
+        collection = self._mongo.db[NOTIFICATIONS_COLLECTION]
+        cursor = collection.find({
+            'state': 'pending',
+            'batch_key': notification['batch_key'],
+            'next_attempt_at': {'$lte': time()}
+        }, {'_id': 1}).sort('next_attempt_at', ASCENDING).limit(self._max_batch_size - 1)
+
+        ids = [n['_id'] for n in cursor]
+        if not ids:
+            return []
+
+        collection.update_many(
+            {'_id': {'$in': ids}, 'state': 'pending'},
+            {'$set': {'state': 'delivering', 'claimed_by': notification['_id']}}
+        )
+        return list(collection.find({'_id': {'$in': ids}, 'claimed_by': notification['_id']}))
+
+    def _session(self, e):
+        with self._lock:
+            session = self._sessions.get(e)
+            if not session:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_maxsize=self._max_concurrent_deliveries_per_endpoint)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._sessions[e] = session
+            return session
+
+    def _deliver(self, notifications):
+        e = notifications[0]['endpoint']
+        try:
+            send(self._session(e), notifications, self._timeout_seconds)
+            self._mongo.db[NOTIFICATIONS_COLLECTION].delete_many({'_id': {'$in': [n['_id'] for n in notifications]}})
+        except:
+            exception = format_exc()
+            for notification in notifications:
+                self._retry(notification, exception)
+        finally:
+            with self._lock:
+                self._in_flight[e] -= 1
+                if not self._in_flight[e]:
+                    del self._in_flight[e]
+            # the endpoint might have more notifications waiting
+            self._wake.set()
+
+    def _retry(self, notification, exception):
+        trials = notification['trials'] + 1
+        url = notification['connector_access']['url']
+
+        if trials > self._max_retries:
+            self._tee('Could not notify server {} after {} trials: {}'.format(url, trials, exception))
+            self._mongo.db[NOTIFICATIONS_COLLECTION].update_one({'_id': notification['_id']}, {'$set': {
+                'state': 'failed',
+                'trials': trials,
+                'exception': exception,
+                'connector_access': remove_secrets(notification['connector_access'])
+            }})
+            return
+
+        backoff_seconds = self._retry_backoff_seconds * 2 ** (trials - 1)
+        self._mongo.db[NOTIFICATIONS_COLLECTION].update_one({'_id': notification['_id']}, {'$set': {
+            'state': 'pending',
+            'claimed_by': None,
+            'trials': trials,
+            'exception': exception,
+            'next_attempt_at': time() + backoff_seconds
+        }})
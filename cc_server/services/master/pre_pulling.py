@@ -0,0 +1,75 @@
+from threading import Thread, Lock, Semaphore
+from time import sleep
+from traceback import format_exc
+
+
+class ImagePrePuller:
+    def __init__(self, config, tee, cluster, scheduler):
+        self._config = config
+        self._tee = tee
+        self._cluster = cluster
+        self._scheduler = scheduler
+
+        pre_pulling = self._config.server_master['image_pre_pulling']
+        self._queue_depth = pre_pulling.get('queue_depth', 100)
+        self._interval_seconds = pre_pulling.get('interval_seconds', 10)
+        self._max_concurrent_pulls = pre_pulling.get('max_concurrent_pulls_per_node', 1)
+        self._max_disk_mb = pre_pulling.get('max_disk_mb_per_node')
+
+        self._lock = Lock()
+        self._pulls = set()
+        self._pull_limits = {}
+
+        # node_name -> set of images pulled ahead of placement
+        self._pre_pulled = {}
+
+        Thread(target=self._pre_pulling_loop).start()
+
+    def _pre_pulling_loop(self):
+        while True:
+            try:
+                self._pre_pull()
+            except:
+                self._tee('Image pre-pulling failed: {}'.format(format_exc()))
+            sleep(self._interval_seconds)
+
+    def _pre_pull(self):
+        placements = self._scheduler.predict_placements(self._queue_depth)
+
+        for node_name, image, registry_auth in placements:
+            key = (node_name, image)
+            with self._lock:
+                if key in self._pulls:
+                    continue
+
+            images = self._cluster.images(node_name)
+            if image in images:
+                continue
+
+            if self._max_disk_mb is not None and self._disk_usage(node_name, images) >= self._max_disk_mb:
+                continue
+
+            with self._lock:
+                limit = self._pull_limits.setdefault(node_name, Semaphore(self._max_concurrent_pulls))
+            if not limit.acquire(blocking=False):
+                continue
+
+            with self._lock:
+                self._pulls.add(key)
+            Thread(target=self._pull, args=(node_name, image, registry_auth, limit)).start()
+
+    def _pull(self, node_name, image, registry_auth, limit):
+        try:
+            self._tee('Pre-pull image {} on node {}.'.format(image, node_name))
+            self._cluster.update_image(node_name, image, registry_auth)
+            with self._lock:
+                self._pre_pulled.setdefault(node_name, set()).add(image)
+        finally:
+            with self._lock:
+                self._pulls.discard((node_name, image))
+            limit.release()
+
+    def _disk_usage(self, node_name, images):
+        with self._lock:
+            pre_pulled = set(self._pre_pulled.get(node_name, []))
+        return sum(images[image].get('size', 0) for image in pre_pulled if image in images)
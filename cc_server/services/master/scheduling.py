@@ -1,5 +1,6 @@
 from cc_server.commons.helper import generate_secret
 from cc_server.commons.states import end_states
+from cc_server.services.master.node_health import DEGRADED, OFFLINE
 from cc_server.services.master.scheduling_strategies.task_selection import FIFO
 from cc_server.services.master.scheduling_strategies.caching import OneCachePerTaskNoDuplicates
 from cc_server.services.master.scheduling_strategies.container_allocation import binpack, spread
@@ -14,6 +15,7 @@ def application_container_prototype(container_ram):
         'task_id': None,
         'data_container_ids': [],
         'callbacks': [],
+        'callbacks_count': 0,
         'callback_key': generate_secret(),
         'cluster_node': None,
         'container_ram': container_ram
@@ -42,11 +44,9 @@ class Scheduler:
             cluster=self._cluster
         )
 
-    def schedule(self):
-        dc_ram = self._config.defaults['data_container_description']['container_ram']
-
+    def _nodes(self):
         nodes_list = self._mongo.db['nodes'].find(
-            {'is_online': True},
+            {'is_online': True, 'status': {'$nin': [DEGRADED, OFFLINE]}},
             {'cluster_node': 1, 'total_ram': 1}
         )
 
@@ -75,58 +75,138 @@ class Scheduler:
 
             nodes[node_name] = node
 
-        for task in self._task_selection:
-            ac_ram = task['application_container_description']['container_ram']
-            required_dc_ram = dc_ram
-            if task.get('no_cache'):
-                required_dc_ram = 0
+        return nodes
 
-            if not _is_task_fitting(nodes, ac_ram, required_dc_ram):
-                description = 'Task is too large for cluster.'
-                self._state_handler.transition('tasks', task['_id'], 'failed', description)
-                continue
+    def predict_placements(self, num_tasks):
+        # estimate the nodes the next waiting tasks will be placed on, without placing them
+        dc_ram = self._config.defaults['data_container_description']['container_ram']
+        dc_image = self._config.defaults['data_container_description']['image']
+        dc_registry_auth = self._config.defaults['data_container_description'].get('registry_auth')
+
+        nodes = self._nodes()
+        placements = []
 
-            application_container = application_container_prototype(ac_ram)
-            application_container['task_id'] = [task['_id']]
-            application_container['username'] = task['username']
-            application_container_id = self._mongo.db['application_containers'].insert_one(application_container).inserted_id
+        for i, task in enumerate(self._task_selection):
+            if i >= num_tasks:
+                break
 
+            description = task['application_container_description']
+            to_place = [(description['container_ram'], description['image'], description.get('registry_auth'))]
             if not task.get('no_cache'):
-                self._caching.apply(application_container_id)
+                to_place.append((dc_ram, dc_image, dc_registry_auth))
+            to_place.sort(key=lambda x: x[0], reverse=True)
 
-            data_containers = self._mongo.db['data_containers'].find(
-                {'state': -1},
-                {'_id': 1, 'cluster_node': 1}
-            )
+            for ram, image, registry_auth in to_place:
+                node_name = self._container_allocation(nodes, ram)
+                if node_name:
+                    nodes[node_name]['free_ram'] -= ram
+                    placements.append((node_name, image, registry_auth))
+                    continue
 
-            assign_to_node = []
-            for data_container in data_containers:
-                if not data_container['cluster_node']:
-                    assign_to_node.append((dc_ram, data_container['_id'], 'data_containers'))
-            assign_to_node.append((ac_ram, application_container_id, 'application_containers'))
-            assign_to_node.sort(reverse=True)
+                # the cluster is full, the container is expected on the largest node that fits it once RAM has been
+                # freed, containers not fitting any node are skipped
+                fitting = [name for name, node in nodes.items() if node['total_ram'] >= ram]
+                if fitting:
+                    node_name = max(fitting, key=lambda name: nodes[name]['total_ram'])
+                    placements.append((node_name, image, registry_auth))
 
-            failed = False
+        return placements
 
-            for ram, _id, collection in assign_to_node:
-                node_name = self._container_allocation(nodes, ram)
-                if not node_name:
-                    failed = True
-                    break
-                self._mongo.db[collection].update_one(
-                    {'_id': _id},
-                    {'$set': {'cluster_node': node_name}}
-                )
-                nodes[node_name]['free_ram'] -= ram
-
-            if failed:
-                for ram, _id, collection in assign_to_node:
-                    self._mongo.db[collection].delete_one({'_id': _id})
+    def schedule(self):
+        dc_ram = self._config.defaults['data_container_description']['container_ram']
+
+        nodes = self._nodes()
+        transitions = []
+
+        # the created transitions collected so far are applied even if the round fails, otherwise containers of
+        # earlier tasks would stay unborn while reserving RAM on their nodes
+        try:
+            for task in self._task_selection:
+                pending = []
+                try:
+                    if not self._schedule_task(task, nodes, dc_ram, transitions, pending):
+                        break
+                except:
+                    self._remove_pending_containers(pending)
+                    raise
+        finally:
+            self._state_handler.transition_many(transitions)
+
+    def _schedule_task(self, task, nodes, dc_ram, transitions, pending):
+        # returns False if the cluster is full, pending contains the containers of the task not yet transitioned
+        ac_ram = task['application_container_description']['container_ram']
+        required_dc_ram = dc_ram
+        if task.get('no_cache'):
+            required_dc_ram = 0
+
+        if not _is_task_fitting(nodes, ac_ram, required_dc_ram):
+            description = 'Task is too large for cluster.'
+            transitions.append(('tasks', task['_id'], 'failed', description))
+            return True
+
+        application_container = application_container_prototype(ac_ram)
+        application_container['task_id'] = [task['_id']]
+        application_container['username'] = task['username']
+        application_container_id = self._mongo.db['application_containers'].insert_one(application_container).inserted_id
+        pending.append(('application_containers', application_container_id))
+
+        if not task.get('no_cache'):
+            self._caching.apply(application_container_id)
+
+        # containers of previous tasks in this round are already assigned to nodes, but not yet created
+        data_containers = self._mongo.db['data_containers'].find(
+            {'state': -1, 'cluster_node': None},
+            {'_id': 1}
+        )
+
+        assign_to_node = []
+        for data_container in data_containers:
+            assign_to_node.append((dc_ram, data_container['_id'], 'data_containers'))
+            pending.append(('data_containers', data_container['_id']))
+        assign_to_node.append((ac_ram, application_container_id, 'application_containers'))
+        assign_to_node.sort(reverse=True)
+
+        failed = False
+        node_names = {}
+
+        for ram, _id, collection in assign_to_node:
+            node_name = self._container_allocation(nodes, ram)
+            if not node_name:
+                failed = True
                 break
+            node_names[_id] = node_name
+            self._mongo.db[collection].update_one(
+                {'_id': _id},
+                {'$set': {'cluster_node': node_name}}
+            )
+            nodes[node_name]['free_ram'] -= ram
 
+        if failed:
             for ram, _id, collection in assign_to_node:
-                description = 'Container created.'
-                self._state_handler.transition(collection, _id, 'created', description)
+                self._mongo.db[collection].delete_one({'_id': _id})
+            del pending[:]
+            return False
+
+        if self._config.defaults['data_container_description'].get('warm_pool_size'):
+            for i, (ram, _id, collection) in enumerate(assign_to_node):
+                if collection == 'data_containers':
+                    pooled_id = self._cluster.claim_pooled_data_container(_id, node_names[_id])
+                    pending.append((collection, pooled_id))
+                    assign_to_node[i] = (ram, pooled_id, collection)
+
+        for ram, _id, collection in assign_to_node:
+            description = 'Container created.'
+            transitions.append((collection, _id, 'created', description))
+        del pending[:]
+        return True
+
+    def _remove_pending_containers(self, pending):
+        # containers of a task failing to be scheduled are removed before they could be used by other tasks
+        for collection, _id in pending:
+            try:
+                self._mongo.db[collection].delete_one({'_id': _id, 'state': -1})
+            except:
+                pass
 
 
 def _is_task_fitting(nodes, ac_ram, dc_ram):
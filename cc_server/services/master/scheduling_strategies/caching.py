@@ -1,4 +1,4 @@
-from cc_server.commons.helper import generate_secret
+from cc_server.commons.helper import generate_secret, secret_paths
 
 
 def data_container_prototype(username, input_files, container_ram):
@@ -10,9 +10,11 @@ def data_container_prototype(username, input_files, container_ram):
         'input_files': input_files,
         'input_file_keys': [generate_secret() for _ in input_files],
         'callbacks': [],
+        'callbacks_count': 0,
         'callback_key': generate_secret(),
         'cluster_node': None,
-        'container_ram': container_ram
+        'container_ram': container_ram,
+        'secret_paths': secret_paths({'input_files': input_files})
     }
 
 
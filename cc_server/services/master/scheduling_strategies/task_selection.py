@@ -1,4 +1,5 @@
 from cc_server.commons.states import state_to_index
+from cc_server.commons.task_templates import resolve_task_template
 
 
 class FIFO:
@@ -10,5 +11,6 @@ class FIFO:
             {'$match': {'state': state_to_index('waiting')}},
             {'$sort': {'created_at': 1}}
         ])
+        templates = {}
         for task in cursor:
-            yield task
+            yield resolve_task_template(self.mongo, task, templates)
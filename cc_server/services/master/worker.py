@@ -1,8 +1,10 @@
 from queue import Queue
-from threading import Thread
+from threading import Thread, Lock
 from time import sleep
+from traceback import format_exc
 
 from cc_server.commons.states import state_to_index, end_states
+from cc_server.commons.task_templates import resolve_task_template
 
 
 def _put(q):
@@ -21,10 +23,17 @@ class Worker:
         self._cluster = cluster
         self._scheduler = scheduler
 
+        self._clean_up_q = Queue(maxsize=1)
         self._scheduling_q = Queue(maxsize=1)
         self._data_container_callback_q = Queue(maxsize=1)
 
+        # containers currently passing through pull -> create -> start
+        self._pipeline_lock = Lock()
+        self._pipeline_ids = set()
+        self._released_pipeline_ids = set()
+
         # initialize permanent threads
+        Thread(target=self._clean_up_loop).start()
         Thread(target=self._scheduling_loop).start()
         Thread(target=self._data_container_callback_loop).start()
 
@@ -56,14 +65,14 @@ class Worker:
                         work_to_do = True
 
             if work_to_do:
-                _put(self._scheduling_q)
+                self.schedule()
                 _put(self._data_container_callback_q)
 
             sleep(self._config.server_master['scheduling_interval_seconds'])
 
     def _container_callback(self):
         self._cluster.clean_up_unused_data_containers()
-        _put(self._scheduling_q)
+        self.schedule()
 
     def container_callback(self):
         Thread(target=self._container_callback).start()
@@ -71,7 +80,26 @@ class Worker:
     def update_node(self, node_name):
         Thread(target=self._cluster.update_node, args=(node_name,)).start()
 
-    def _update_images(self):
+    def _claim_pipeline(self, container_id):
+        with self._pipeline_lock:
+            if container_id in self._pipeline_ids:
+                return False
+            self._pipeline_ids.add(container_id)
+            return True
+
+    def _release_pipeline(self, container_id):
+        with self._pipeline_lock:
+            self._pipeline_ids.discard(container_id)
+            self._released_pipeline_ids.add(container_id)
+
+    def _pipelines_since_last_call(self):
+        # containers passing through a pipeline now or at any time since the previous call
+        with self._pipeline_lock:
+            container_ids = self._pipeline_ids | self._released_pipeline_ids
+            self._released_pipeline_ids = set()
+            return container_ids
+
+    def _start_container_pipelines(self):
         application_containers = list(self._mongo.db['application_containers'].find(
             {'state': state_to_index('created')},
             {'task_id': 1, 'cluster_node': 1}
@@ -81,93 +109,86 @@ class Worker:
             {'cluster_node': 1}
         ))
 
-        nodes = {}
-        i = j = 0
-        for container in application_containers:
-            node_name = container['cluster_node']
-            nodes[node_name] = set()
-            i += 1
+        application_containers = [c for c in application_containers if self._claim_pipeline(c['_id'])]
+        data_containers = [c for c in data_containers if self._claim_pipeline(c['_id'])]
 
-        for container in data_containers:
-            node_name = container['cluster_node']
-            nodes[node_name] = set()
-            j += 1
+        if not application_containers and not data_containers:
+            return
 
-        self._tee('Scheduled:\n{}\tApplication Containers\n{}\tData Containers'.format(i, j))
+        self._tee('Scheduled:\n{}\tApplication Containers\n{}\tData Containers'.format(
+            len(application_containers), len(data_containers)
+        ))
 
+        templates = {}
         for application_container in application_containers:
-            node_name = application_container['cluster_node']
-            task_id = application_container['task_id']
-            task = self._mongo.db['tasks'].find_one({'_id': task_id[0]})
-            registry_auth = None
-            if task['application_container_description'].get('registry_auth'):
-                ra = task['application_container_description']['registry_auth']
-                registry_auth = (ra['username'], ra['password'])
-            nodes[node_name].update([(
+            task_id = application_container['task_id'][0]
+            task = self._mongo.db['tasks'].find_one(
+                {'_id': task_id},
+                {'application_container_description': 1, 'task_template_id': 1}
+            )
+            resolve_task_template(self._mongo, task, templates)
+            Thread(target=self._application_container_pipeline, args=(
+                application_container['_id'],
+                application_container['cluster_node'],
                 task['application_container_description']['image'],
-                registry_auth
-            )])
+                task['application_container_description'].get('registry_auth')
+            )).start()
 
         for data_container in data_containers:
-            node_name = data_container['cluster_node']
-            registry_auth = None
-            if self._config.defaults['data_container_description'].get('registry_auth'):
-                ra = self._config.defaults['data_container_description']['registry_auth']
-                registry_auth = (ra['username'], ra['password'])
-            nodes[node_name].update([(
+            Thread(target=self._data_container_pipeline, args=(
+                data_container['_id'],
+                data_container['cluster_node'],
                 self._config.defaults['data_container_description']['image'],
-                registry_auth
-            )])
-
-        threads = []
-        for node_name, node in nodes.items():
-            for image, registry_auth in node:
-                ra = None
-                if registry_auth:
-                    ra = {'username': registry_auth[0], 'password': registry_auth[1]}
-                t = Thread(target=self._cluster.update_image, args=(
-                    node_name, image, ra
-                ))
-                threads.append(t)
-                t.start()
-        for t in threads:
-            t.join()
-
-    def _create_containers(self):
-        application_containers = self._mongo.db['application_containers'].find(
-            {'state': state_to_index('created')},
-            {'_id': 1}
-        )
-        data_containers = self._mongo.db['data_containers'].find(
-            {'state': state_to_index('created')},
-            {'_id': 1}
-        )
-
-        threads = []
-        for ac in application_containers:
-            t = Thread(target=self._cluster_create_application_container, args=(ac['_id'],))
-            threads.append(t)
-            t.start()
+                self._config.defaults['data_container_description'].get('registry_auth')
+            )).start()
+
+    def _application_container_pipeline(self, application_container_id, node_name, image, registry_auth):
+        try:
+            self._cluster.update_image(node_name, image, registry_auth)
+            if self._cluster.create_container(application_container_id, 'application_containers'):
+                self._cluster_start_application_container(application_container_id)
+        finally:
+            self._release_pipeline(application_container_id)
+
+    def _data_container_pipeline(self, data_container_id, node_name, image, registry_auth):
+        try:
+            self._cluster.update_image(node_name, image, registry_auth)
+            if self._cluster.create_container(data_container_id, 'data_containers'):
+                self._cluster.start_container(data_container_id, 'data_containers')
+        finally:
+            self._release_pipeline(data_container_id)
+
+    def _clean_up_loop(self):
+        while True:
+            self._clean_up_q.get()
 
-        for dc in data_containers:
-            t = Thread(target=self._cluster_create_data_container, args=(dc['_id'],))
-            threads.append(t)
-            t.start()
+            # a container might be created by a pipeline after the clean up listed the containers of the cluster,
+            # such containers must not be reported as vanished
+            self._pipelines_since_last_call()
+            self._cluster.clean_up_containers(self._pipelines_since_last_call)
+            self._cluster.update_garbage_collection_stats()
 
-        for t in threads:
-            t.join()
+            # resources freed by the clean up become available for placement
+            _put(self._scheduling_q)
 
     def _scheduling_loop(self):
         while True:
             self._scheduling_q.get()
 
-            self._cluster.clean_up_containers()
-            self._state_handler.update_task_groups()
-            self._scheduler.schedule()
-            self._update_images()
-            self._create_containers()
+            # containers created before a failure in the round are started nevertheless
+            try:
+                self._scheduler.schedule()
+            except:
+                self._tee('Scheduling failed: {}'.format(format_exc()))
+            try:
+                self._start_container_pipelines()
+            except:
+                self._tee('Could not start container pipelines: {}'.format(format_exc()))
+
+            Thread(target=self._cluster.fill_data_container_pool).start()
 
     def schedule(self):
+        _put(self._clean_up_q)
         _put(self._scheduling_q)
 
     def _cluster_start_application_container(self, application_container_id):
@@ -179,14 +200,6 @@ class Worker:
         if application_container:
             self._cluster.start_container(application_container_id, 'application_containers')
 
-    def _cluster_create_application_container(self, application_container_id):
-        self._cluster.create_container(application_container_id, 'application_containers')
-        Thread(target=self._cluster_start_application_container, args=(application_container_id,)).start()
-
-    def _cluster_create_data_container(self, data_container_id):
-        self._cluster.create_container(data_container_id, 'data_containers')
-        Thread(target=self._cluster.start_container, args=(data_container_id, 'data_containers')).start()
-
     def data_container_callback(self):
         _put(self._data_container_callback_q)
 
@@ -90,6 +90,18 @@ def get_task_groups_query_schema():
     return request_handler.get_query_schema()
 
 
+@app.route('/task-templates/query/schema', methods=['GET'])
+def get_task_templates_query_schema():
+    """
+    .. :quickref: User API; Get json-schema
+
+    Get json-schema used with `POST /task-templates/query endpoint <#post--task-templates-query>`__ for validation
+    purposes.
+
+    """
+    return request_handler.get_query_schema()
+
+
 @app.route('/application-containers/query/schema', methods=['GET'])
 def get_application_containers_query_schema():
     """
@@ -119,7 +131,8 @@ def get_nodes():
     """
     .. :quickref: User API; Query cluster nodes
 
-    Query the status of all nodes in the cluster.
+    Query the status of all nodes in the cluster. The **status** of a node is either *online*, *degraded* or *offline*.
+    No new containers are placed on degraded or offline nodes.
 
     **Example request**
 
@@ -141,8 +154,11 @@ def get_nodes():
                 "active_data_containers": [],
                 "cluster_node": "cc-node2",
                 "debug_info": null,
+                "garbage_collection": {"backlog": 0, "failed": 0, "removed": 12, "retried": 0},
                 "is_online": true,
+                "latency_ms": 2.4,
                 "reserved_ram": 0,
+                "status": "online",
                 "total_cpus": 2,
                 "total_ram": 2002
             }, {
@@ -150,8 +166,11 @@ def get_nodes():
                 "active_data_containers": [],
                 "cluster_node": "cc-node1",
                 "debug_info": null,
+                "garbage_collection": {"backlog": 0, "failed": 0, "removed": 12, "retried": 0},
                 "is_online": true,
+                "latency_ms": 2.4,
                 "reserved_ram": 0,
+                "status": "online",
                 "total_cpus": 2,
                 "total_ram": 2002
             }]
@@ -210,6 +229,7 @@ def post_tasks_query():
     **JSON fields**
 
     * **aggregate** (required): List of steps to be performed as MongoDB aggregation pipeline
+    * **join_history** (optional, default = *false*): If *true* and the events collection is enabled in the server configuration, the transitions and callbacks of every returned document with an _id are added from the events collection.
 
     Take a look at the
     `MongoDB documentation <https://docs.mongodb.com/manual/reference/operator/aggregation-pipeline/>`__ for further
@@ -219,6 +239,15 @@ def post_tasks_query():
 
     $match, $project, $limit, $skip, $count, $sort, $unwind, $group, $sample, $replaceRoot, $addFields.
 
+    Tasks created from a task template (see `POST /tasks endpoint <#post--tasks>`__) do not store the
+    application_container_description of the template. Their documents only contain a **task_template_id** and an
+    application_container_description with their own **parameters**, if the parameters have been varied. Returned
+    tasks with a task_template_id are completed with the application_container_description of their template, but the
+    aggregation pipeline only sees the fields stored in the task documents. For example, a $match on
+    application_container_description.image does not find these tasks. Query the
+    `POST /task-templates/query endpoint <#post--task-templates-query>`__ instead and match the tasks by their
+    task_template_id.
+
     **Example request**
 
     .. sourcecode:: http
@@ -254,6 +283,49 @@ def post_tasks_query():
     return request_handler.post_tasks_query()
 
 
+@app.route('/events', methods=['GET'])
+def get_events():
+    """
+    .. :quickref: User API; Stream state transitions
+
+    Stream the state transitions of tasks, task groups and containers as they happen. Admin users receive the
+    transitions of every user, while standard users only receive transitions of their own tasks. The endpoint requires
+    the events collection to be enabled in the server configuration.
+
+    The response is streamed as newline delimited JSON, one transition per line. With the query parameter
+    **format=sse** or an Accept header of *text/event-stream*, Server-Sent Events are sent instead. Empty lines (or SSE
+    comments) are sent as heartbeat and should be ignored. The stream is closed by the server after a configured amount
+    of time.
+
+    Every transition contains an **offset**. To resume after a disconnect, send the offset of the last transition
+    received as query parameter **offset**, or as Last-Event-ID header when using Server-Sent Events. Without an offset
+    the stream starts with the oldest transition stored. Transitions are delivered in the order of their offsets and only
+    once every transition with a lower offset has been written, such that resuming with an offset does not skip any
+    transition. Therefore transitions are delivered with a delay of one to two seconds, plus the duration of the slowest
+    write in progress. Writes taking longer than 60 seconds, e.g. interrupted by a crash, no longer hold back the
+    stream, and transitions they commit later may be missed. Offsets rely on the clocks of the servers writing
+    transitions being synchronized within one second.
+
+    **Example request**
+
+    .. sourcecode:: http
+
+        GET /events?offset=5a0d9a6ee004231a26ed1880 HTTP/1.1
+
+    **Example response**
+
+    .. sourcecode:: http
+
+        HTTP/1.1 200 OK
+        Content-Type: application/x-ndjson
+
+        {"offset": "5a0d9a6fe004231a26ed1881", "collection": "tasks", "_id": "57f63f73e004231a26ed187e", "state": 2, "description": "Container created.", "timestamp": 1510841967.2, "exception": null, "caused_by": {"application_container_id": "5a0d9a6ee004231a26ed187f"}}
+        {"offset": "5a0d9a70e004231a26ed1882", "collection": "tasks", "_id": "57f63f73e004231a26ed187e", "state": 3, "description": "Callback with callback_type 3 and has been sent.", "timestamp": 1510841968.9, "exception": null, "caused_by": {"application_container_id": "5a0d9a6ee004231a26ed187f"}}
+
+    """
+    return request_handler.get_events()
+
+
 @app.route('/tasks', methods=['POST'])
 def post_tasks():
     """
@@ -274,6 +346,12 @@ def post_tasks():
     * **result_files** (required): List of destinations of result files in remote data repositories. This list maps to the list of local_result_files specified in the container image configuration.
     * **notifications** (optional): List of HTTP servers that will receive a notification as soon as the task succeeded, failed or got cancelled.
 
+    When sending multiple tasks, the JSON object can contain a **notifications** list next to the **tasks** list. These servers receive a notification with the task_group_id as soon as all tasks of the group have finished.
+
+    A notification server with **batch** set to *true* accepts batched notifications. If the administrator enabled batching, notifications for this server are collected for a short time and sent with a single request, in which the **meta_data** field is a list with one entry per notification.
+
+    For parameter sweeps, a **task_template** with the fields of a single task can be sent together with either a list of **variations** or a **product**. Every variation is an object with optional **parameters**, **input_files** and **result_files**, which replace the respective fields of the template for one task. A **product** contains lists of these fields and creates one task per combination. The application_container_description of the template is stored only once and referenced by the task_template_id of the tasks, which do not contain it. The template can be retrieved with the `POST /task-templates/query endpoint <#post--task-templates-query>`__. Like multiple tasks, a task template creates a task group and accepts a **notifications** list.
+
     **Example request 1: single task**
 
     .. sourcecode:: http
@@ -426,6 +504,60 @@ def post_tasks():
             }]
         }
 
+    **Example request 3: task template**
+
+    .. sourcecode:: http
+
+        POST /tasks HTTP/1.1
+        Accept: application/json
+
+        {
+            "task_template": {
+                "application_container_description": {
+                    "image": "docker.io/curiouscontainers/cc-sample-app",
+                    "container_ram": 1024
+                },
+                "input_files": [],
+                "result_files": [null, null]
+            },
+            "product": {
+                "parameters": [["--alpha", "0.1"], ["--alpha", "0.2"]],
+                "input_files": [[{
+                    "connector_type": "http",
+                    "connector_access": {
+                        "url": "https://my-domain.tld/input_files/A/some_data.csv"
+                    }
+                }], [{
+                    "connector_type": "http",
+                    "connector_access": {
+                        "url": "https://my-domain.tld/input_files/B/some_data.csv"
+                    }
+                }]]
+            }
+        }
+
+    **Example response 3**
+
+    .. sourcecode:: http
+
+        HTTP/1.1 200 OK
+        Vary: Accept
+        Content-Type: application/json
+
+        {
+            "task_group_id": "57fbf45df62690000101afa4",
+            "task_template_id": "57fbf45df62690000101afa3",
+            "tasks": [{
+                "_id": "57fbf45df62690000101afa5"
+            }, {
+                "_id": "57fbf45df62690000101afa6"
+            }, {
+                "_id": "57fbf45df62690000101afa7"
+            }, {
+                "_id": "57fbf45df62690000101afa8"
+            }]
+        }
+
     """
     return request_handler.post_tasks()
 
@@ -503,6 +635,74 @@ def post_tasks_cancel():
     return request_handler.post_tasks_cancel()
 
 
+@app.route('/tasks/wait', methods=['POST'])
+def post_tasks_wait():
+    """
+    .. :quickref: User API; Wait for tasks
+
+    Send JSON object with one or more task IDs, in order to wait until all of these tasks reached an end state
+    (success, failed or cancelled). The request blocks until the tasks are finished or the timeout expires and returns
+    the states of all tasks. Admin users can wait for tasks of every other user, while standard users can only wait for
+    their own tasks.
+
+    **JSON fields**
+
+    * **tasks** (required): List of objects containing task IDs.
+    * **timeout_seconds** (optional): Maximum time to wait. Capped and defaulting to the server configuration.
+
+    The response field **finished** is *false* if the timeout expired before all tasks reached an end state.
+
+    **Example request**
+
+    .. sourcecode:: http
+
+        POST /tasks/wait HTTP/1.1
+        Accept: application/json
+
+        {
+            "tasks": [{
+                "_id": "57c3f73ae004232bd8b9b005"
+            },{
+                "_id": "57c3f73ae004232bd8b9b006"
+            }],
+            "timeout_seconds": 30
+        }
+
+    **Example response**
+
+    .. sourcecode:: http
+
+        HTTP/1.1 200 OK
+        Vary: Accept
+        Content-Type: application/json
+
+        {
+            "tasks": [{
+                "_id": "57c3f73ae004232bd8b9b005",
+                "state": 3
+            }, {
+                "_id": "57c3f73ae004232bd8b9b006",
+                "state": 4
+            }],
+            "finished": true
+        }
+
+    """
+    return request_handler.post_tasks_wait()
+
+
+@app.route('/task-groups/wait', methods=['POST'])
+def post_task_groups_wait():
+    """
+    .. :quickref: User API; Wait for task groups
+
+    Works exactly like the `POST /tasks/wait endpoint <#post--tasks-wait>`__, but waits for task groups given in the
+    **task_groups** field and returns them in the **task_groups** field of the response.
+
+    """
+    return request_handler.post_task_groups_wait()
+
+
 @app.route('/token', methods=['GET'])
 def get_token():
     """
@@ -551,6 +751,22 @@ def post_task_groups_query():
     return request_handler.post_task_groups_query()
 
 
+@app.route('/task-templates/query', methods=['POST'])
+def post_task_templates_query():
+    """
+    .. :quickref: User API; Query task templates
+
+    Send JSON object with a query, in order to retrieve a list of task templates. A task template contains the
+    **application_container_description** shared by all tasks created from it, the **task_group_id** of these tasks and
+    the **username**.
+    Admin users can retrieve task templates from every other user, while standard users can only retrieve their own task
+    templates.
+
+    Works exactly like the `POST /tasks/query endpoint <#post--tasks-query>`__.
+    """
+    return request_handler.post_task_templates_query()
+
+
 @app.route('/application-containers/query', methods=['POST'])
 def post_application_containers_query():
     """
@@ -1,16 +1,21 @@
 import json
-import chardet
 import jsonschema
-from time import time
-from flask import request, jsonify
+from time import time, sleep
+from bson.objectid import ObjectId
+from pymongo import ReturnDocument
+from flask import request, jsonify, Response, stream_with_context
 from traceback import format_exc
 from werkzeug.exceptions import BadRequest, Unauthorized
 
 from cc_server.commons.authorization import Authorize
-from cc_server.commons.helper import prepare_response, prepare_input, get_ip
+from cc_server.commons.helper import prepare_response, prepare_input, get_ip, secret_paths, decode_data
 from cc_server.commons.schemas import query_schema, tasks_schema, callback_schema, tasks_cancel_schema, nodes_schema
-from cc_server.commons.states import is_state, end_states, StateHandler
+from cc_server.commons.schemas import tasks_wait_schema, task_groups_wait_schema
+from cc_server.commons.states import is_state, end_states, state_to_index, StateHandler
 from cc_server.commons.database import Mongo
+from cc_server.commons.events import Events
+from cc_server.commons.task_templates import TASK_TEMPLATES_COLLECTION, expand_task_template, template_tasks_count
+from cc_server.commons.task_templates import resolve_task_template
 
 
 def task_group_prototype():
@@ -19,7 +24,10 @@ def task_group_prototype():
         'created_at': None,
         'transitions': [],
         'username': None,
-        'task_ids': []
+        'task_ids': [],
+        'tasks_count': 0,
+        'finished_count': 0,
+        'success_count': 0
     }
 
 
@@ -68,9 +76,7 @@ def validation(schema):
     def dec(func):
         def wrapper(self, *args, **kwargs):
             try:
-                rawdata = request.data
-                enc = chardet.detect(rawdata)
-                data = rawdata.decode(enc['encoding'])
+                data = decode_data(request.data, request.mimetype_params.get('charset'))
                 json_input = json.loads(data)
                 jsonschema.validate(json_input, schema)
                 json_input = prepare_input(json_input)
@@ -99,6 +105,10 @@ class RequestHandler:
             tee=self._tee,
             mongo=self._mongo
         )
+        self._events = Events(
+            config=self._config,
+            mongo=self._mongo
+        )
 
     @log
     @auth(require_admin=False, require_credentials=False)
@@ -137,9 +147,12 @@ class RequestHandler:
         nodes = self._mongo.db['nodes'].find({}, {
             'cluster_node': 1,
             'is_online': 1,
+            'status': 1,
+            'latency_ms': 1,
             'debug_info': 1,
             'total_ram': 1,
-            'total_cpus': 1
+            'total_cpus': 1,
+            'garbage_collection': 1
         })
         result = []
         for node in nodes:
@@ -194,12 +207,23 @@ class RequestHandler:
         return self._cancel(json_input)
 
     def _cancel_tasks(self, json_input, username):
-        for task in json_input['tasks']:
-            self._is_task(task, username)
-        responses = []
-        for task in json_input['tasks']:
-            responses.append(self._cancel(task))
-        return {'tasks': responses}
+        task_ids = [task['_id'] for task in json_input['tasks']]
+        query = {'_id': {'$in': task_ids}}
+        if username:
+            query['username'] = username
+        found = set(task['_id'] for task in self._mongo.db['tasks'].find(query, {'_id': 1}))
+        for task_id in task_ids:
+            if task_id not in found:
+                raise BadRequest('Task not found: {}'.format(task_id))
+
+        description = 'Task cancelled.'
+        self._state_handler.transition_many([('tasks', task_id, 'cancelled', description) for task_id in task_ids])
+
+        tasks = {task['_id']: task for task in self._mongo.db['tasks'].find(
+            {'_id': {'$in': task_ids}},
+            {'_id': 1, 'state': 1}
+        )}
+        return {'tasks': [tasks[task_id] for task_id in task_ids]}
 
     def _is_task(self, json_input, username):
         if username:
@@ -230,43 +254,133 @@ class RequestHandler:
         self._master.send_json({'action': 'container_callback'})
         return jsonify(prepare_response(response))
 
-    def _register_task(self, json_input, task_group_id):
-        json_input['username'] = request.authorization.username
-        json_input['state'] = -1
-        json_input['created_at'] = None
-        json_input['trials'] = 0
-        json_input['transitions'] = []
-        json_input['task_group_id'] = [task_group_id]
-        task_id = self._mongo.db['tasks'].insert_one(json_input).inserted_id
+    def _wait(self, collection, ids, timeout_seconds):
+        # blocks until all documents reached an end state, sleep yields to other requests in gevent workers
+        username = None
+        if not self._authorize.verify_user(require_credentials=False):
+            username = request.authorization.username
 
-        self._state_handler.transition('tasks', task_id, 'created', 'Task created.')
-        self._state_handler.transition('tasks', task_id, 'waiting', 'Task waiting.')
+        query = {'_id': {'$in': ids}}
+        if username:
+            query['username'] = username
+        found = set(c['_id'] for c in self._mongo.db[collection].find(query, {'_id': 1}))
+        for _id in ids:
+            if _id not in found:
+                raise BadRequest('Not found: {}'.format(_id))
+
+        wait = self._config.server_web.get('wait', {})
+        poll_interval_seconds = wait.get('poll_interval_seconds', 1)
+        max_timeout_seconds = wait.get('max_timeout_seconds', 60)
+        if timeout_seconds is None or timeout_seconds > max_timeout_seconds:
+            timeout_seconds = max_timeout_seconds
+
+        deadline = time() + timeout_seconds
+        pending = list(ids)
+        while pending:
+            pending = [c['_id'] for c in self._mongo.db[collection].find(
+                {'_id': {'$in': pending}, 'state': {'$nin': end_states()}},
+                {'_id': 1}
+            )]
+            if not pending or time() >= deadline:
+                break
+            sleep(min(poll_interval_seconds, max(deadline - time(), 0)))
+
+        docs = {c['_id']: c for c in self._mongo.db[collection].find(
+            {'_id': {'$in': ids}},
+            {'_id': 1, 'state': 1}
+        )}
+        return {
+            collection: [docs[_id] for _id in ids],
+            'finished': not pending
+        }
 
-        self._mongo.db['task_groups'].update({'_id': task_group_id}, {
-            '$push': {'task_ids': task_id},
+    @log
+    @auth(require_admin=False, require_credentials=False)
+    @validation(tasks_wait_schema)
+    def post_tasks_wait(self, json_input):
+        ids = [task['_id'] for task in json_input['tasks']]
+        return jsonify(prepare_response(self._wait('tasks', ids, json_input.get('timeout_seconds'))))
+
+    @log
+    @auth(require_admin=False, require_credentials=False)
+    @validation(task_groups_wait_schema)
+    def post_task_groups_wait(self, json_input):
+        ids = [task_group['_id'] for task_group in json_input['task_groups']]
+        return jsonify(prepare_response(self._wait('task_groups', ids, json_input.get('timeout_seconds'))))
+
+    def _register_tasks(self, json_tasks, task_group_id):
+        # all tasks of a request are inserted with their created and waiting transitions in a single write
+        for json_task in json_tasks:
+            json_task['username'] = request.authorization.username
+            json_task['trials'] = 0
+            json_task['task_group_id'] = [task_group_id]
+            json_task['secret_paths'] = secret_paths(json_task)
+
+        task_ids = self._state_handler.insert_many('tasks', json_tasks, [
+            ('created', 'Task created.'),
+            ('waiting', 'Task waiting.')
+        ])
+
+        self._mongo.db['task_groups'].update_one({'_id': task_group_id}, {
+            '$set': {'task_ids': task_ids},
         })
 
-        return {'_id': task_id}
+        return [{'_id': task_id} for task_id in task_ids]
 
     def _create_task(self, json_input, task_group_id):
-        return self._register_task(json_input, task_group_id)
+        return self._register_tasks([json_input], task_group_id)[0]
 
     def _create_tasks(self, json_input, task_group_id):
-        responses = []
-        for json_task in json_input['tasks']:
-            responses.append(self._register_task(json_task, task_group_id))
+        responses = self._register_tasks(json_input['tasks'], task_group_id)
         return {'tasks': responses, 'task_group_id': task_group_id}
 
+    def _create_template_tasks(self, json_input, task_group_id):
+        task_template = {
+            'username': request.authorization.username,
+            'task_group_id': task_group_id,
+            'application_container_description': json_input['task_template']['application_container_description']
+        }
+        task_template['secret_paths'] = secret_paths(task_template)
+        task_template_id = self._mongo.db[TASK_TEMPLATES_COLLECTION].insert_one(task_template).inserted_id
+        self._mongo.db['task_groups'].update_one(
+            {'_id': task_group_id},
+            {'$set': {'task_template_id': task_template_id}}
+        )
+
+        json_tasks = expand_task_template(json_input)
+        for json_task in json_tasks:
+            json_task['task_template_id'] = task_template_id
+
+        responses = self._register_tasks(json_tasks, task_group_id)
+        return {'tasks': responses, 'task_group_id': task_group_id, 'task_template_id': task_template_id}
+
     @log
     @auth(require_admin=False, require_credentials=False)
     @validation(tasks_schema)
     def post_tasks(self, json_input):
+        is_template = 'task_template' in json_input
+        tasks_count = len(json_input.get('tasks', [0]))
+        if is_template:
+            tasks_count = template_tasks_count(json_input)
+            max_tasks = self._config.server_web.get('task_templates', {}).get('max_tasks', 100000)
+            if tasks_count > max_tasks:
+                raise BadRequest('Task template expands to {} tasks, at most {} are allowed.'.format(
+                    tasks_count, max_tasks
+                ))
+            if not tasks_count:
+                raise BadRequest('Task template does not expand to any task.')
+
         task_group = task_group_prototype()
         task_group['username'] = request.authorization.username
-        task_group['tasks_count'] = len(json_input.get('tasks', [0]))
+        task_group['tasks_count'] = tasks_count
+        if (json_input.get('tasks') or is_template) and json_input.get('notifications'):
+            task_group['notifications'] = json_input['notifications']
+        task_group['secret_paths'] = secret_paths(task_group)
         task_group_id = self._mongo.db['task_groups'].insert_one(task_group).inserted_id
         self._state_handler.transition('task_groups', task_group_id, 'created', 'Task group created.')
-        if json_input.get('tasks'):
+        if is_template:
+            result = self._create_template_tasks(json_input, task_group_id)
+        elif json_input.get('tasks'):
             result = self._create_tasks(json_input, task_group_id)
         else:
             result = self._create_task(json_input, task_group_id)
@@ -285,6 +399,14 @@ class RequestHandler:
             raise BadRequest('Could not execute aggregation pipeline with MongoDB: {}'.format(format_exc()))
 
         result = list(cursor)
+        if json_input.get('join_history'):
+            self._events.join(collection, result)
+        if collection == 'tasks':
+            # tasks created from a task template are returned with the application_container_description of the
+            # template, but are only matched by the fields stored in the task documents
+            templates = {}
+            for task in result:
+                resolve_task_template(self._mongo, task, templates)
         return {collection: result}
 
     @log
@@ -299,6 +421,12 @@ class RequestHandler:
     def post_data_containers_query(self, json_input):
         return jsonify(prepare_response(self._aggregate(json_input, 'data_containers')))
 
+    @log
+    @auth(require_admin=False, require_credentials=False)
+    @validation(query_schema)
+    def post_task_templates_query(self, json_input):
+        return jsonify(prepare_response(self._aggregate(json_input, TASK_TEMPLATES_COLLECTION)))
+
     @log
     @auth(require_admin=False, require_credentials=False)
     @validation(query_schema)
@@ -311,6 +439,58 @@ class RequestHandler:
     def post_task_groups_query(self, json_input):
         return jsonify(prepare_response(self._aggregate(json_input, 'task_groups')))
 
+    @log
+    @auth(require_admin=False, require_credentials=False)
+    def get_events(self):
+        if not self._events.enabled:
+            raise BadRequest('The event feed requires the events collection, see mongo.events in the configuration.')
+
+        username = None
+        if not self._authorize.verify_user(require_credentials=False):
+            username = request.authorization.username
+
+        offset = request.headers.get('Last-Event-ID') or request.args.get('offset')
+        if offset:
+            try:
+                offset = ObjectId(offset)
+            except:
+                raise BadRequest('Invalid offset: {}'.format(offset))
+
+        is_sse = request.args.get('format') == 'sse' or 'text/event-stream' in request.headers.get('Accept', '')
+
+        event_feed = self._config.server_web.get('event_feed', {})
+        poll_interval_seconds = event_feed.get('poll_interval_seconds', 1)
+        heartbeat_seconds = event_feed.get('heartbeat_seconds', 15)
+        max_stream_seconds = event_feed.get('max_stream_seconds', 300)
+        batch_size = event_feed.get('batch_size', 1000)
+
+        def stream(offset):
+            # the stream ends after max_stream_seconds, clients reconnect with the offset of the last event received
+            start = time()
+            last_sent = start
+            while time() - start < max_stream_seconds:
+                events = self._events.feed(username, offset, batch_size)
+                for event in events:
+                    offset = event['offset']
+                    data = json.dumps(prepare_response(event))
+                    if is_sse:
+                        yield 'id: {}\ndata: {}\n\n'.format(offset, data)
+                    else:
+                        yield data + '\n'
+                    last_sent = time()
+
+                if len(events) == batch_size:
+                    continue
+
+                if time() - last_sent >= heartbeat_seconds:
+                    yield ':\n\n' if is_sse else '\n'
+                    last_sent = time()
+
+                sleep(poll_interval_seconds)
+
+        mimetype = 'text/event-stream' if is_sse else 'application/x-ndjson'
+        return Response(stream_with_context(stream(offset)), mimetype=mimetype)
+
     @log
     @validation(callback_schema)
     def post_application_container_callback(self, json_input):
@@ -334,8 +514,15 @@ class RequestHandler:
             task_id = c['task_id'][0]
             task = self._mongo.db['tasks'].find_one(
                 {'_id': task_id},
-                {'input_files': 1, 'no_cache': 1, 'result_files': 1, 'application_container_description': 1}
+                {
+                    'input_files': 1,
+                    'no_cache': 1,
+                    'result_files': 1,
+                    'application_container_description': 1,
+                    'task_template_id': 1
+                }
             )
+            resolve_task_template(self._mongo, task)
 
             response = {
                 'task_id': str(task_id),
@@ -410,17 +597,40 @@ class RequestHandler:
         return jsonify({})
 
     def _validate_callback(self, json_input, collection):
-        c = self._mongo.db[collection].find_one({'_id': json_input['container_id']})
-        if is_state(c['state'], 'failed') or is_state(c['state'], 'success'):
-            return
-
         json_input['timestamp'] = time()
 
-        self._mongo.db[collection].update({'_id': c['_id']}, {
-            '$push': {'callbacks': json_input}
-        })
+        update = {'$inc': {'callbacks_count': 1}}
+        if not self._events.enabled:
+            update['$push'] = {'callbacks': json_input}
+
+        # the callback is counted atomically, concurrent callbacks of a container see different counts
+        c = self._mongo.db[collection].find_one_and_update(
+            {
+                '_id': json_input['container_id'],
+                'state': {'$nin': [state_to_index('failed'), state_to_index('success')]}
+            },
+            update,
+            projection={'callbacks_count': 1, 'username': 1},
+            return_document=ReturnDocument.BEFORE
+        )
+        if not c:
+            return
 
-        if json_input['callback_type'] != len(c['callbacks']):
+        callbacks_count = c.get('callbacks_count')
+        if callbacks_count is None:
+            # containers created before callbacks were counted, only then the callbacks array is read
+            legacy = self._mongo.db[collection].find_one({'_id': c['_id']}, {'callbacks': 1})
+            callbacks_count = len(legacy.get('callbacks', []))
+            if 'callbacks' in update.get('$push', {}):
+                # the callback of this request has been pushed already
+                callbacks_count -= 1
+            if callbacks_count:
+                self._mongo.db[collection].update_one({'_id': c['_id']}, {'$inc': {'callbacks_count': callbacks_count}})
+
+        if self._events.enabled:
+            self._events.append(collection, c['_id'], 'callback', json_input, c.get('username'))
+
+        if json_input['callback_type'] != callbacks_count:
             description = 'Callback with invalid callback_type has been sent.'
             self._state_handler.transition(collection, c['_id'], 'failed', description)
             return